@@ -0,0 +1,89 @@
+"""Compares the original PIL thumbnail/pad/save preprocessing with preprocess.letterbox().
+
+Usage: python benchmarks/bench_preprocess.py [--iterations N] [image.jpg ...]
+
+Without image arguments, synthetic JPEGs at typical Frigate crop and full-frame sizes are used.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from preprocess import letterbox  # noqa: E402
+
+SYNTHETIC_SIZES = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+
+
+def legacy_preprocess(data, workdir):
+    # the path speciesid.on_message used before preprocess.py existed
+    image = Image.open(BytesIO(data))
+    image.save(os.path.join(workdir, "fullsized.jpg"), format="JPEG")
+    max_size = (224, 224)
+    image.thumbnail(max_size)
+    padded_image = ImageOps.expand(image, border=((max_size[0] - image.size[0]) // 2,
+                                                  (max_size[1] - image.size[1]) // 2),
+                                   fill='black')
+    padded_image.save(os.path.join(workdir, "shrunk.jpg"), format="JPEG")
+    return np.array(padded_image)
+
+
+def synthetic_jpeg(width, height):
+    y, x = np.mgrid[0:height, 0:width]
+    rng = np.random.default_rng(width * height)
+    pixels = np.stack([(x * 255 // width), (y * 255 // height), ((x + y) * 127 // (width + height))], axis=-1)
+    pixels = (pixels + rng.integers(0, 40, pixels.shape)).clip(0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def timeit(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('images', nargs='*', help="JPEG files to benchmark with")
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.images:
+        samples = []
+        for path in args.images:
+            with open(path, 'rb') as f:
+                samples.append((os.path.basename(path), f.read()))
+    else:
+        samples = [(f"synthetic {w}x{h}", synthetic_jpeg(w, h)) for w, h in SYNTHETIC_SIZES]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"{'image':<24}{'legacy p50':>12}{'legacy p95':>12}{'new p50':>10}{'new p95':>10}{'speedup':>9}"
+              f"{'mean abs diff':>15}")
+        for name, data in samples:
+            legacy_p50, legacy_p95 = timeit(lambda: legacy_preprocess(data, workdir), args.iterations)
+            new_p50, new_p95 = timeit(lambda: letterbox(data), args.iterations)
+
+            # the legacy path can come out a pixel short when the padding is odd, so compare the overlap
+            old = legacy_preprocess(data, workdir).astype(np.int16)
+            new = letterbox(data).astype(np.int16)
+            h, w = min(old.shape[0], 224), min(old.shape[1], 224)
+            diff = np.abs(old[:h, :w] - new[:h, :w]).mean()
+
+            print(f"{name:<24}{legacy_p50:>10.2f}ms{legacy_p95:>10.2f}ms{new_p50:>8.2f}ms{new_p95:>8.2f}ms"
+                  f"{legacy_p50 / new_p50:>8.1f}x{diff:>15.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Shows the effect of the date/hour columns and indexes on the web UI queries.
+
+Usage: python benchmarks/bench_schema.py [--rows N] [--db path]
+
+Builds a synthetic detections table in the original schema, times the original
+function-on-column queries and prints their plans, then migrates the database in place
+and does the same for the rewritten queries.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+
+from migrations import create_detections, migrate  # noqa: E402
+
+
+def species_names(count=120):
+    # real scientific names, so pages rendered from the generated data look like the real thing
+    conn = sqlite3.connect(os.path.join(REPO_DIR, 'birdnames.db'))
+    names = [row[0] for row in conn.execute("SELECT scientific_name FROM birdnames ORDER BY scientific_name")]
+    conn.close()
+    return names[::max(1, len(names) // count)][:count]
+
+
+SPECIES = species_names()
+
+OLD_QUERIES = {
+    'daily summary': ("""
+        SELECT display_name, COUNT(*), STRFTIME('%H', detection_time) AS hour
+        FROM (SELECT * FROM detections WHERE DATE(detection_time) = ?) AS subquery
+        GROUP BY display_name, hour
+    """, lambda day, name: (day,)),
+    'by hour': ("""
+        SELECT * FROM detections
+        WHERE strftime('%Y-%m-%d', detection_time) = ? AND strftime('%H', detection_time) = ?
+        ORDER BY detection_time
+    """, lambda day, name: (day, '08')),
+    'by species': ("""
+        SELECT * FROM detections
+        WHERE display_name = ? AND strftime('%Y-%m-%d', detection_time) = ?
+        ORDER BY detection_time
+    """, lambda day, name: (name, day)),
+    'earliest date': ("SELECT MIN(date(detection_time)) FROM detections", lambda day, name: ()),
+}
+
+NEW_QUERIES = {
+    'daily summary': ("""
+        SELECT display_name, COUNT(*), detection_hour AS hour
+        FROM detections WHERE detection_date = ?
+        GROUP BY display_name, detection_hour
+    """, lambda day, name: (day,)),
+    'by hour': ("""
+        SELECT * FROM detections WHERE detection_date = ? AND detection_hour = ?
+        ORDER BY detection_time
+    """, lambda day, name: (day, 8)),
+    'by species': ("""
+        SELECT * FROM detections WHERE display_name = ? AND detection_date = ?
+        ORDER BY detection_time
+    """, lambda day, name: (name, day)),
+    'earliest date': ("SELECT MIN(detection_date) FROM detections", lambda day, name: ()),
+}
+
+
+def populate(conn, rows):
+    cursor = conn.cursor()
+    create_detections(cursor)
+    start = datetime(2020, 1, 1)
+    span = int(timedelta(days=4 * 365).total_seconds())
+    rng = random.Random(42)
+
+    def generate():
+        for i in range(rows):
+            detection_time = start + timedelta(seconds=rng.randrange(span))
+            yield (detection_time.strftime("%Y-%m-%d %H:%M:%S"), rng.randrange(964), rng.uniform(0.7, 1.0),
+                   rng.choice(SPECIES), str(i), f"event-{i}", 'birdcam')
+
+    cursor.executemany("""
+        INSERT INTO detections (detection_time, detection_index, score, display_name, category_name,
+        frigate_event, camera_name) VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, generate())
+    conn.commit()
+
+
+def run(conn, queries, label, iterations):
+    print(f"\n{label}")
+    day, name = '2022-06-15', SPECIES[3]
+    for query_name, (sql, params) in queries.items():
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params(day, name))]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            conn.execute(sql, params(day, name)).fetchall()
+        elapsed = (time.perf_counter() - start) / iterations * 1000
+        print(f"  {query_name:<14}{elapsed:>10.2f} ms   plan: {'; '.join(plan)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--db', help="where to build the database (default: a temporary file)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.db or os.path.join(workdir, 'speciesid.db')
+        conn = sqlite3.connect(path)
+        print(f"Generating {args.rows} detections...", flush=True)
+        populate(conn, args.rows)
+
+        run(conn, OLD_QUERIES, "Original schema and queries", args.iterations)
+
+        start = time.perf_counter()
+        migrate(conn)
+        print(f"\nMigration took {time.perf_counter() - start:.1f} s")
+
+        run(conn, NEW_QUERIES, "Migrated schema and rewritten queries", args.iterations)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
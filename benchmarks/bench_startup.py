@@ -0,0 +1,115 @@
+"""Compares cold start time and memory of the web UI and ingest processes.
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+
+Each scenario runs in a fresh interpreter, from a scratch directory with an empty database, and
+reports the time until it has served its first request (web) or loaded the model (ingest), its
+peak RSS, and whether the ML stack was imported. "web (combined)" reproduces what the web process
+used to inherit when both processes were forked from speciesid.py, which loaded the model before
+forking.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+CHILD_PRELUDE = f"""
+import time
+started = time.perf_counter()
+import json, resource, sys, yaml
+sys.path.insert(0, {REPO_DIR!r})
+with open('./config/config.yml') as f:
+    config = yaml.safe_load(f)
+"""
+
+CHILD_REPORT = """
+print(json.dumps({
+    'ready_seconds': time.perf_counter() - started,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'modules': len(sys.modules),
+    'ml_stack': any(name in sys.modules for name in ('cv2', 'tflite_runtime', 'numpy')),
+}))
+"""
+
+SCENARIOS = {
+    'web (combined)': """
+import ingest
+import webui
+from inference import build_engine
+build_engine(config['classification'])
+response = webui.init_app(config).test_client().get('/')
+assert response.status_code == 200, response.status_code
+""",
+    'web': """
+import webui
+response = webui.init_app(config).test_client().get('/')
+assert response.status_code == 200, response.status_code
+""",
+    'ingest': """
+import ingest
+from inference import build_engine
+build_engine(config['classification'])
+""",
+}
+
+
+def prepare_workdir(workdir):
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'config'), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, 'birdnames.db'), workdir)
+    with open(os.path.join(REPO_DIR, 'config', 'config.yml')) as f:
+        config = yaml.safe_load(f)
+    # absolute model path, so the scenarios don't need a copy of it
+    config['classification']['model'] = os.path.join(REPO_DIR, config['classification']['model'])
+    with open(os.path.join(workdir, 'config', 'config.yml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+    sys.path.insert(0, REPO_DIR)
+    import db
+    from migrations import migrate
+    conn = db.connect(os.path.join(workdir, 'data', 'speciesid.db'))
+    migrate(conn)
+    conn.close()
+
+
+def run_scenario(workdir, code):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD_PRELUDE + code + CHILD_REPORT], cwd=workdir,
+                            check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_seconds'] = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='whosatmyfeeder-startup-')
+    try:
+        prepare_workdir(workdir)
+        print(f"{'scenario':<16}{'ready':>10}{'process':>10}{'peak RSS':>12}{'modules':>9}  ML stack")
+        for name, code in SCENARIOS.items():
+            results = [run_scenario(workdir, code) for _ in range(args.runs)]
+            ready = statistics.median(result['ready_seconds'] for result in results)
+            process = statistics.median(result['process_seconds'] for result in results)
+            rss = statistics.median(result['max_rss_mb'] for result in results)
+            print(f"{name:<16}{ready * 1000:>8.0f}ms{process * 1000:>8.0f}ms{rss:>9.1f} MB"
+                  f"{results[0]['modules']:>9}  {'yes' if results[0]['ml_stack'] else 'no'}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""Offline load tests for the ingest pipeline and the web UI.
+
+Usage:
+  python benchmarks/loadtest.py ingest [--rate 20] [--cameras 2] [--duration 30] [--replay events.jsonl]
+  python benchmarks/loadtest.py web [--rows 1000000] [--threads 8] [--duration 30]
+
+The ingest mode starts a fake Frigate HTTP server that serves snapshots and accepts sublabel
+POSTs, then feeds synthetic (or recorded) frigate/events messages to ingest.on_message the way
+paho's network thread would. It reports throughput, end-to-end latency and dropped events.
+
+The web mode generates a large speciesid.db and hammers the dashboard routes from several threads.
+
+Everything runs in a temporary working directory; the real config and database are never touched.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from bench_preprocess import SYNTHETIC_SIZES, synthetic_jpeg  # noqa: E402
+
+SNAPSHOT_PATH = re.compile(r'^/api/events/([^/]+)/(snapshot|thumbnail)\.jpg')
+SUBLABEL_PATH = re.compile(r'^/api/events/([^/]+)/sub_label$')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class FakeFrigate:
+    """Serves snapshot.jpg for any event id and records sublabel POSTs."""
+
+    def __init__(self, images, latency_ms=0):
+        self.images = images
+        self.latency = latency_ms / 1000
+        self.snapshots = 0
+        self.sublabels = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                match = SNAPSHOT_PATH.match(self.path)
+                if not match:
+                    self.send_error(404)
+                    return
+                time.sleep(fake.latency)
+                image = fake.images[hash(match.group(1)) % len(fake.images)]
+                with fake.lock:
+                    fake.snapshots += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not SUBLABEL_PATH.match(self.path):
+                    self.send_error(404)
+                    return
+                with fake.lock:
+                    fake.sublabels += 1
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def synthetic_stream(rate, cameras, duration, updates):
+    """Yields (offset seconds, payload dict) for bird events spread over the cameras.
+
+    `rate` is new bird events per second. Each event sends a 'new' message, `updates` updates
+    with a changing snapshot and an 'end' message, like Frigate does while a bird is tracked.
+    """
+    rng = random.Random(1)
+    messages = []
+    count = int(rate * duration)
+    start = time.time()
+    for i in range(count):
+        offset = i / rate
+        camera = f"birdcam{i % cameras}"
+        event_id = f"{start + offset:.6f}-{i:06d}"
+        after = {'id': event_id, 'camera': camera, 'label': 'bird', 'start_time': start + offset,
+                 'snapshot_time': start + offset, 'top_score': 0.6}
+        messages.append((offset, {'type': 'new', 'after': dict(after)}))
+        for update in range(updates):
+            after['snapshot_time'] += 0.5
+            after['top_score'] = min(1.0, after['top_score'] + rng.uniform(0, 0.05))
+            messages.append((offset + 0.5 * (update + 1), {'type': 'update', 'after': dict(after)}))
+        messages.append((offset + 0.5 * (updates + 1), {'type': 'end', 'after': dict(after)}))
+    messages.sort(key=lambda message: message[0])
+    return messages
+
+
+def recorded_stream(path, rate):
+    """Reads one frigate/events payload per line and spaces the messages `rate` per second."""
+    messages = []
+    with open(path) as f:
+        for i, line in enumerate(line for line in f if line.strip()):
+            payload = json.loads(line)
+            payload = payload.get('payload', payload)
+            messages.append((i / rate, payload))
+    return messages
+
+
+def write_config(workdir, frigate_url, cameras, overrides):
+    with open(os.path.join(REPO_DIR, 'config', 'config.yml')) as f:
+        config = yaml.safe_load(f)
+    config['frigate']['frigate_url'] = frigate_url
+    config['frigate']['camera'] = cameras
+    config['classification']['model'] = os.path.join(REPO_DIR, config['classification']['model'])
+    config['pipeline']['stats_interval'] = 0
+    for section, values in overrides.items():
+        config.setdefault(section, {}).update(values)
+    os.makedirs(os.path.join(workdir, 'config'), exist_ok=True)
+    with open(os.path.join(workdir, 'config', 'config.yml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def prepare_workdir(workdir):
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, 'birdnames.db'), workdir)
+    os.chdir(workdir)
+
+
+class StubEngine:
+    """Stands in for the inference engine to measure the pipeline without model cost."""
+
+    def __init__(self, delay_ms):
+        from inference import Category
+        self.delay = delay_ms / 1000
+        self.category = Category(index=1, score=0.9, display_name='Cyanocitta cristata', category_name='stub')
+
+    def classify(self, image):
+        time.sleep(self.delay)
+        return [self.category]
+
+    def stats(self):
+        return {}
+
+    def format_stats(self):
+        return "inference: stubbed"
+
+
+def run_ingest(args):
+    if args.images:
+        images = []
+        for path in args.images:
+            with open(path, 'rb') as f:
+                images.append(f.read())
+    else:
+        images = [synthetic_jpeg(w, h) for w, h in SYNTHETIC_SIZES[:2]]
+    frigate = FakeFrigate(images, latency_ms=args.frigate_latency_ms)
+
+    cameras = [f"birdcam{i}" for i in range(args.cameras)]
+    if args.replay:
+        messages = recorded_stream(args.replay, args.rate)
+        cameras = sorted({payload['after']['camera'] for _, payload in messages})
+    else:
+        messages = synthetic_stream(args.rate, args.cameras, args.duration, args.updates)
+
+    workdir = tempfile.mkdtemp(prefix='whosatmyfeeder-loadtest-')
+    try:
+        prepare_workdir(workdir)
+        overrides = {'classification': {'threshold': 0.1}}
+        if args.classification_cache:
+            overrides['classification_cache'] = {'enabled': True, 'mode': args.classification_cache}
+        write_config(workdir, frigate.url, cameras, overrides)
+
+        import ingest
+        import metrics
+        ingest.load_config()
+        ingest.setupdb()
+        ingest.start_pipeline()
+        if args.stub_classifier is not None:
+            ingest.engine = StubEngine(args.stub_classifier)
+        ingest.firstmessage = False
+
+        latencies = []
+        original_finish = ingest.slow_event_log.finish
+
+        def record_finish(trace):
+            latencies.append(time.monotonic() - trace.started)
+            original_finish(trace)
+
+        ingest.slow_event_log.finish = record_finish
+
+        topic = ingest.config['frigate']['main_topic'] + '/events'
+        print(f"Replaying {len(messages)} messages from {len(cameras)} cameras against {frigate.url}", flush=True)
+        start = time.monotonic()
+        for offset, payload in messages:
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            ingest.on_message(None, None, FakeMessage(topic, json.dumps(payload).encode()))
+        sent = time.monotonic() - start
+
+        ingest.pipeline.join()
+        ingest.writer.flush()
+        elapsed = time.monotonic() - start
+
+        events = ingest.EVENTS.collect()['samples']
+        outcomes = {labels['outcome']: value for _, labels, value in events}
+        print(f"\nSent {len(messages)} messages in {sent:.1f} s, finished after {elapsed:.1f} s")
+        print(f"Processed events: {len(latencies)} ({len(latencies) / elapsed:.1f} events/s)")
+        print(f"End-to-end latency: p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, max {max(latencies, default=0) * 1000:.1f} ms")
+        print(f"Dropped events: {outcomes.get('dropped', 0)}")
+        print(f"Outcomes: {json.dumps(outcomes, sort_keys=True)}")
+        print(f"Fake Frigate served {frigate.snapshots} snapshots and received {frigate.sublabels} sublabels")
+        writes = ingest.writer.stats()
+        print(f"Database writes: {writes['writes']} in {writes['transactions']} transactions "
+              f"({writes['writes'] / max(writes['transactions'], 1):.1f} per commit)")
+        print(ingest.pipeline.format_stats())
+        print(ingest.engine.format_stats())
+        if ingest.event_tracker is not None:
+            print(ingest.event_tracker.format_stats())
+        if ingest.classification_cache is not None:
+            print(ingest.classification_cache.format_stats())
+        if args.metrics:
+            print(metrics.render(os.path.join(workdir, 'no-exports')))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_web(args):
+    from bench_schema import populate
+
+    workdir = tempfile.mkdtemp(prefix='whosatmyfeeder-loadtest-')
+    try:
+        prepare_workdir(workdir)
+        write_config(workdir, 'http://127.0.0.1:9', ['birdcam'], {})
+
+        import db
+        from migrations import migrate
+        conn = db.connect()
+        print(f"Generating {args.rows} detections...", flush=True)
+        populate(conn, args.rows)
+        migrate(conn)
+        dates = [row[0] for row in conn.execute(
+            "SELECT DISTINCT detection_date FROM species_hourly_counts ORDER BY RANDOM() LIMIT 50")]
+        conn.close()
+
+        import webui
+        with open('./config/config.yml') as f:
+            webui.init_app(yaml.safe_load(f))
+        urls = ['/'] + [f'/daily_summary/{date}' for date in dates] + \
+               [f'/detections/by_hour/{date}/{random.randrange(24)}' for date in dates]
+
+        timings = {}
+        lock = threading.Lock()
+        deadline = time.monotonic() + args.duration
+
+        def hammer():
+            client = webui.app.test_client()
+            rng = random.Random(threading.get_ident())
+            local = {}
+            while time.monotonic() < deadline:
+                url = rng.choice(urls)
+                route = url.split('/')[1] or 'index'
+                start = time.perf_counter()
+                response = client.get(url)
+                local.setdefault(route, []).append(time.perf_counter() - start)
+                if response.status_code != 200:
+                    print(f"{url} returned {response.status_code}", flush=True)
+            with lock:
+                for route, values in local.items():
+                    timings.setdefault(route, []).extend(values)
+
+        threads = [threading.Thread(target=hammer) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        total = sum(len(values) for values in timings.values())
+        print(f"\n{total} requests in {args.duration} s from {args.threads} threads ({total / args.duration:.1f} req/s)")
+        for route, values in sorted(timings.items()):
+            print(f"  {route:<14}{len(values):>8} requests   p50 {percentile(values, 0.5) * 1000:>8.2f} ms"
+                  f"   p99 {percentile(values, 0.99) * 1000:>8.2f} ms")
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    ingest = subparsers.add_parser('ingest', help="replay frigate/events messages through the ingest pipeline")
+    ingest.add_argument('--rate', type=float, default=10, help="new bird events per second")
+    ingest.add_argument('--cameras', type=int, default=2)
+    ingest.add_argument('--duration', type=float, default=30, help="seconds of synthetic events")
+    ingest.add_argument('--updates', type=int, default=5, help="update messages per event")
+    ingest.add_argument('--replay', help="file of recorded frigate/events payloads, one JSON object per line")
+    ingest.add_argument('--images', nargs='*', help="JPEG snapshots for the fake Frigate to serve")
+    ingest.add_argument('--frigate-latency-ms', type=float, default=0)
+    ingest.add_argument('--stub-classifier', type=float, metavar='MS',
+                        help="replace the model with a stub that takes MS milliseconds per image")
+    ingest.add_argument('--classification-cache', choices=['exact', 'perceptual'],
+                        help="enable the classification cache in this mode")
+    ingest.add_argument('--metrics', action='store_true', help="print the ingest metrics at the end")
+    ingest.set_defaults(func=run_ingest)
+
+    web = subparsers.add_parser('web', help="hammer the dashboard routes against a large generated database")
+    web.add_argument('--rows', type=int, default=1000000)
+    web.add_argument('--threads', type=int, default=8)
+    web.add_argument('--duration', type=float, default=30)
+    web.set_defaults(func=run_web)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import db
+import meta
+
+# Frigate publishes events over MQTT only as they happen, so whatever happened while ingest was
+# stopped or cut off from the broker would be missed. The start time of the newest event
+# ingest processed is kept in the meta table. On startup and after every reconnect, the bird
+# events since then are read back from Frigate's events API and classified like live ones, a
+# batch at a time whenever the live pipeline has nothing queued. Events that are already
+# stored are skipped, and the frigate_event unique key makes a repeat harmless anyway.
+# Missed events go in oldest first. When the pipeline turns one away, the run stops, its start
+# time is kept as where to resume from, and the run is retried after a growing delay.
+
+RESUME_FROM = 'catch_up_resume_from'
+
+
+def list_events(session, frigate_url, cameras, after, page_size=100, timeout=15):
+    """Yields pages of bird events on the cameras that started after `after`, newest first."""
+    before = None
+    while True:
+        params = {'cameras': ','.join(cameras), 'labels': 'bird', 'after': after, 'limit': page_size}
+        if before is not None:
+            params['before'] = before
+        response = session.get(f"{frigate_url}/api/events", params=params, timeout=timeout)
+        response.raise_for_status()
+        events = response.json()
+        if not events:
+            return
+        yield events
+        if len(events) < page_size:
+            return
+        before = min(event['start_time'] for event in events)
+
+
+class CatchUp:
+    """Classifies the events missed while ingest wasn't listening, from a background thread.
+
+    `cameras()` returns the cameras to catch up on, and is asked again on every run, since
+    sharded ingest can start watching cameras after startup. `submit(after_data)` queues an
+    event without making room for it, returning False when
+    there is none, and `is_idle()` tells whether live events are waiting. Events are submitted
+    `batch_size` at a time, so the inference engine can batch them, and only while nothing
+    live is queued.
+    """
+
+    def __init__(self, frigate_url, cameras, submit, is_idle, max_age_hours=24, overlap_seconds=60,
+                 page_size=100, batch_size=8, timeout=15, poll_interval=0.05, max_retry_delay=60):
+        self.frigate_url = frigate_url
+        self.cameras = cameras
+        self.submit = submit
+        self.is_idle = is_idle
+        self.max_age = max_age_hours * 3600
+        self.overlap = overlap_seconds
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_retry_delay = max_retry_delay
+        self.retry_delay = 0
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=1))
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = {'runs': 0, 'listed': 0, 'already_stored': 0, 'no_snapshot': 0, 'submitted': 0,
+                         'rejected': 0, 'failed_runs': 0}
+
+    def start(self):
+        threading.Thread(target=self._run, name="catch-up", daemon=True).start()
+
+    def trigger(self):
+        """Asks for a catch-up run, e.g. after (re)connecting to the broker. Runs already asked for coalesce."""
+        self.wakeup.set()
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.counters[key] += amount
+
+    def _run(self):
+        conn = db.connect()
+        retry = None
+        while True:
+            self.wakeup.wait(retry)
+            self.wakeup.clear()
+            try:
+                retry = self.run_once(conn)
+            except Exception as e:
+                retry = None
+                self._count('failed_runs')
+                print(f"Catching up on missed events failed: {e}", flush=True)
+
+    def _save_resume_from(self, conn, after):
+        with conn:
+            meta.set_value(conn, RESUME_FROM, after)
+
+    def run_once(self, conn):
+        """Submits the missed events. Returns how long to wait before retrying, or None when done."""
+        last_event_time = meta.get_value(conn, meta.LAST_EVENT_TIME)
+        if last_event_time is None:
+            # a new install has nothing to catch up on
+            return None
+        cameras = list(self.cameras())
+        if not cameras:
+            return None
+        after = float(last_event_time) - self.overlap
+        resume_from = meta.get_value(conn, RESUME_FROM)
+        if resume_from is not None:
+            # the last run stopped early, or never finished
+            after = min(after, float(resume_from))
+        after = max(after, time.time() - self.max_age)
+        self._save_resume_from(conn, after)
+        self._count('runs')
+        start = time.monotonic()
+
+        missed = []
+        for events in list_events(self.session, self.frigate_url, cameras, after, self.page_size, self.timeout):
+            self._count('listed', len(events))
+            placeholders = ', '.join('?' * len(events))
+            stored = {row[0] for row in conn.execute(
+                f"SELECT frigate_event FROM detections WHERE frigate_event IN ({placeholders})",
+                [event['id'] for event in events])}
+            for event in events:
+                if event['id'] in stored:
+                    self._count('already_stored')
+                elif not event.get('has_snapshot', True):
+                    self._count('no_snapshot')
+                else:
+                    missed.append(event)
+        missed.sort(key=lambda event: event['start_time'])
+
+        since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(after))
+        submitted = 0
+        for i in range(0, len(missed), self.batch_size):
+            while not self.is_idle():
+                time.sleep(self.poll_interval)
+            for event in missed[i:i + self.batch_size]:
+                if not self.submit(event):
+                    # everything older went in, so the next run can start from here
+                    self._save_resume_from(conn, event['start_time'] - self.overlap)
+                    self._count('rejected')
+                    self.retry_delay = min(self.max_retry_delay, max(1, self.retry_delay * 2))
+                    print(f"Pipeline is full, pausing catch-up after {submitted} missed events since {since}, "
+                          f"retrying in {self.retry_delay} s", flush=True)
+                    return self.retry_delay
+                submitted += 1
+                self._count('submitted')
+
+        self._save_resume_from(conn, None)
+        self.retry_delay = 0
+        print(f"Caught up on {submitted} missed events since {since} in {time.monotonic() - start:.1f} s", flush=True)
+        return None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"runs {s['runs']}, listed {s['listed']}, already stored {s['already_stored']}, "
+                f"without snapshot {s['no_snapshot']}, submitted {s['submitted']}, rejected {s['rejected']}, "
+                f"failed runs {s['failed_runs']}")
+
+
+def build_catch_up(config, submit, is_idle, cameras=None):
+    catch_up_config = config.get('catch_up') or {}
+    if not catch_up_config.get('enabled', True):
+        return None
+    if cameras is None:
+        def cameras():
+            return config['frigate']['camera']
+    return CatchUp(config['frigate']['frigate_url'], cameras, submit, is_idle,
+                   max_age_hours=catch_up_config.get('max_age_hours', 24),
+                   overlap_seconds=catch_up_config.get('overlap_seconds', 60),
+                   page_size=catch_up_config.get('page_size', 100),
+                   batch_size=catch_up_config.get('batch_size', 8),
+                   timeout=catch_up_config.get('timeout', 15),
+                   max_retry_delay=catch_up_config.get('max_retry_delay', 60))
@@ -0,0 +1,35 @@
+# detection_changes is an append-only log of writes to detections. The ingest process adds a
+# row in the same transaction as each insert or update, and the web process follows the log to
+# push new detections to open browsers. Only the most recent rows are kept.
+
+CHANGE_LOG_SIZE = 10000
+
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detection_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            frigate_event TEXT NOT NULL,
+            change_type TEXT NOT NULL,
+            detection_date TEXT NOT NULL,
+            detection_hour INTEGER NOT NULL,
+            display_name TEXT NOT NULL,
+            old_detection_date TEXT,
+            old_detection_hour INTEGER,
+            old_display_name TEXT
+        )
+    """)
+
+
+def record_change(cursor, frigate_event, change_type, new, old=None):
+    """Logs a change. new and old are (detection_date, detection_hour, display_name) tuples."""
+    old = tuple(old) if old is not None else (None, None, None)
+    cursor.execute("""
+        INSERT INTO detection_changes (frigate_event, change_type, detection_date, detection_hour, display_name,
+        old_detection_date, old_detection_hour, old_display_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (frigate_event, change_type) + tuple(new) + old)
+
+    change_id = cursor.lastrowid
+    if change_id % 1000 == 0:
+        cursor.execute("DELETE FROM detection_changes WHERE id <= ?", (change_id - CHANGE_LOG_SIZE,))
+    return change_id
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import time
+
+import cv2
+import numpy as np
+
+EXACT = 'exact'
+PERCEPTUAL = 'perceptual'
+
+
+def exact_hash(image):
+    return hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+
+
+def perceptual_hash(image):
+    """64-bit difference hash: compares neighbouring pixels of a 9x8 grayscale thumbnail.
+
+    Re-encoded or slightly shifted crops of the same still bird hash to values only a few bits apart.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ClassificationCache:
+    """Remembers recent classification results per camera, keyed by the model input they came from.
+
+    In exact mode a result is reused only for a byte-identical 224x224 input. In perceptual mode
+    any cached input on the same camera whose hash is within `hamming_threshold` bits matches.
+    Entries expire after `ttl` seconds so a different bird in the same spot is eventually
+    classified again, and each camera keeps at most `max_entries` of them, dropping the oldest.
+
+    Lookups take no lock, so cache hits don't queue the classify workers behind each other:
+    put() builds each camera's entries anew under the lock and swaps them in, and a published
+    dict is never changed. The hit and miss counters are updated without the lock too, so
+    they may miss the odd increment.
+    """
+
+    def __init__(self, mode=EXACT, max_entries=256, ttl=300, hamming_threshold=4):
+        if mode not in (EXACT, PERCEPTUAL):
+            raise ValueError(f"Unknown classification cache mode: {mode}")
+        self.mode = mode
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hamming_threshold = hamming_threshold
+        self.cameras = {}
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    def key(self, image):
+        return perceptual_hash(image) if self.mode == PERCEPTUAL else exact_hash(image)
+
+    def get(self, camera, key):
+        entries = self.cameras.get(camera)
+        if entries:
+            match = self._find(entries, key)
+            if match is not None:
+                stored, categories = entries[match]
+                if time.monotonic() - stored <= self.ttl:
+                    self.counters['hits'] += 1
+                    return categories
+        self.counters['misses'] += 1
+        return None
+
+    def _find(self, entries, key):
+        if key in entries:
+            return key
+        if self.mode == PERCEPTUAL:
+            # newest first: a still bird most likely matches the frame we saw last
+            for candidate in reversed(entries):
+                if hamming_distance(candidate, key) <= self.hamming_threshold:
+                    return candidate
+        return None
+
+    def put(self, camera, key, categories):
+        now = time.monotonic()
+        with self.lock:
+            entries = {}
+            expired = 0
+            for stored_key, entry in self.cameras.get(camera, {}).items():
+                if now - entry[0] > self.ttl:
+                    expired += 1
+                elif stored_key != key:
+                    entries[stored_key] = entry
+            entries[key] = (now, categories)
+            for stored_key in list(entries)[:max(0, len(entries) - self.max_entries)]:
+                del entries[stored_key]
+            self.cameras[camera] = entries
+            self.counters['expired'] += expired
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['entries'] = sum(len(entries) for entries in self.cameras.values())
+        lookups = result['hits'] + result['misses']
+        result['hit_rate'] = result['hits'] / lookups if lookups else 0.0
+        return result
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"classification cache: hits {s['hits']}, misses {s['misses']}, "
+                f"hit rate {s['hit_rate']:.1%}, entries {s['entries']}, expired {s['expired']}")
+
+
+def build_classification_cache(cache_config):
+    cache_config = cache_config or {}
+    if not cache_config.get('enabled', False):
+        return None
+    return ClassificationCache(mode=cache_config.get('mode', EXACT),
+                               max_entries=cache_config.get('max_entries', 256),
+                               ttl=cache_config.get('ttl', 300),
+                               hamming_threshold=cache_config.get('hamming_threshold', 4))
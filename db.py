@@ -0,0 +1,164 @@
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+DBPATH = './data/speciesid.db'
+
+# how long a connection waits on a lock held by the other process before giving up
+BUSY_TIMEOUT_MS = 5000
+
+PRAGMAS = [
+    "PRAGMA busy_timeout = %d" % BUSY_TIMEOUT_MS,
+    # only takes effect on a database without tables yet, so new installs can free space in the
+    # background (retention.maintain); older ones need `manage.py compact --full` once
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    # with WAL, readers never block the writer and the writer never blocks readers
+    "PRAGMA journal_mode = WAL",
+    # in WAL mode NORMAL is still crash safe; only the last transactions can be lost on power failure
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+]
+
+
+def connect(path=DBPATH, check_same_thread=True):
+    # uri=True lets archives be attached read-only with file:...?mode=ro
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=check_same_thread, uri=True)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Keeps read connections open between requests instead of connecting for every query.
+
+    Connections are handed to one thread at a time, so this works with both a thread pool
+    and a server that starts a new thread per request.
+    """
+
+    def __init__(self, path=DBPATH, max_idle=8):
+        self.path = path
+        self.idle = queue.LifoQueue(maxsize=max_idle)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            # never hand the next borrower an open transaction
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self.idle.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+
+_read_pool = None
+_read_pool_lock = threading.Lock()
+
+
+def read_connection():
+    """Borrows a pooled read connection: `with read_connection() as conn: ...`"""
+    global _read_pool
+    if _read_pool is None:
+        with _read_pool_lock:
+            if _read_pool is None:
+                _read_pool = ConnectionPool()
+    return _read_pool.connection()
+
+
+class Writer:
+    """Owns the ingest process's only write connection and groups writes into short transactions.
+
+    submit(func, *args) queues func(cursor, *args). The writer thread runs whatever is queued,
+    up to `max_batch` operations, inside one transaction. It never waits for more: a lone write
+    commits at once, and writes that arrive during a commit are grouped into the next one. Each
+    operation gets its own savepoint so a failing one doesn't undo the others. Futures are
+    resolved after the commit, so a caller that sees a result knows it is on disk.
+    """
+
+    def __init__(self, path=DBPATH, max_batch=50):
+        self.path = path
+        self.max_batch = max_batch
+        self.operations = queue.Queue()
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.writes = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args):
+        future = Future()
+        self.operations.put((func, args, future))
+        return future
+
+    def execute(self, func, *args):
+        return self.submit(func, *args).result()
+
+    def flush(self):
+        """Waits until everything submitted so far is committed."""
+        self.execute(lambda cursor: None)
+
+    def _next_batch(self):
+        batch = [self.operations.get()]
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.operations.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = connect(self.path)
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        while True:
+            batch = self._next_batch()
+            results = []
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                for func, args, future in batch:
+                    cursor.execute("SAVEPOINT operation")
+                    try:
+                        results.append((future, func(cursor, *args), None))
+                        cursor.execute("RELEASE operation")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO operation")
+                        cursor.execute("RELEASE operation")
+                        results.append((future, None, e))
+                cursor.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                print(f"Database write failed: {e}", flush=True)
+                for func, args, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self.lock:
+                self.transactions += 1
+                self.writes += len(batch)
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'transactions': self.transactions,
+                'writes': self.writes,
+                'pending': self.operations.qsize(),
+            }
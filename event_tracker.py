@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+class TrackedEvent:
+    def __init__(self, now):
+        self.classified_signature = None
+        self.classified_at = None
+        self.pending = False
+        self.last_seen = now
+
+
+class EventTracker:
+    """Decides which Frigate event messages are worth classifying.
+
+    Frigate publishes a 'new' message, a stream of 'update' messages and an 'end' message per
+    tracked object. Updates that carry the same snapshot as the one we already classified are
+    skipped, and updates that arrive within `window` seconds of the last classification are
+    coalesced into a single pending classification that runs on the next update outside the
+    window or on the 'end' message.
+    """
+
+    def __init__(self, window=2.0, ttl=3600):
+        self.window = window
+        self.ttl = ttl
+        self.events = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+        self.counters = {
+            'seen': 0,
+            'classified': 0,
+            'skipped_unchanged': 0,
+            'coalesced': 0,
+            'expired': 0,
+        }
+
+    @staticmethod
+    def signature(after_data):
+        snapshot_time = after_data.get('snapshot_time')
+        top_score = after_data.get('top_score')
+        if snapshot_time is None and top_score is None:
+            return None
+        return snapshot_time, top_score
+
+    def should_classify(self, event_type, after_data):
+        now = time.monotonic()
+        event_id = after_data['id']
+        signature = self.signature(after_data)
+
+        with self.lock:
+            self.counters['seen'] += 1
+            self._sweep(now)
+
+            tracked = self.events.get(event_id)
+            if tracked is None:
+                tracked = TrackedEvent(now)
+                self.events[event_id] = tracked
+            tracked.last_seen = now
+
+            unchanged = signature is not None and signature == tracked.classified_signature
+
+            if event_type == 'end':
+                # the event is over, so make sure its final snapshot has been classified once
+                del self.events[event_id]
+                if unchanged and not tracked.pending:
+                    self.counters['skipped_unchanged'] += 1
+                    return False
+            elif unchanged:
+                tracked.pending = False
+                self.counters['skipped_unchanged'] += 1
+                return False
+            elif tracked.classified_at is not None and now - tracked.classified_at < self.window:
+                tracked.pending = True
+                self.counters['coalesced'] += 1
+                return False
+
+            tracked.classified_signature = signature
+            tracked.classified_at = now
+            tracked.pending = False
+            self.counters['classified'] += 1
+            return True
+
+    def _sweep(self, now):
+        # drop events whose 'end' message we never saw
+        if now - self.last_sweep < min(self.ttl, 60):
+            return
+        self.last_sweep = now
+        stale = [event_id for event_id, tracked in self.events.items() if now - tracked.last_seen > self.ttl]
+        for event_id in stale:
+            del self.events[event_id]
+        self.counters['expired'] += len(stale)
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['tracked'] = len(self.events)
+            result['avoided'] = result['skipped_unchanged'] + result['coalesced']
+            return result
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"events: seen {s['seen']}, classified {s['classified']}, avoided {s['avoided']} "
+                f"(unchanged {s['skipped_unchanged']}, coalesced {s['coalesced']}), "
+                f"tracked {s['tracked']}, expired {s['expired']}")
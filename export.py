@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+
+from queries import EXPORT_COLUMNS
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# rows are sent in chunks of about this many bytes rather than one write per row
+CHUNK_SIZE = 64 * 1024
+
+
+def _chunked(lines):
+    buffer = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _csv_lines(records):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(EXPORT_COLUMNS)
+    for record in records:
+        writer.writerow([record[column] for column in EXPORT_COLUMNS])
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    yield output.getvalue()
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps({column: record[column] for column in EXPORT_COLUMNS}) + '\n'
+
+
+def stream_records(records, export_format):
+    """Turns an iterable of detection dicts into chunks of CSV or newline-delimited JSON."""
+    lines = _csv_lines(records) if export_format == 'csv' else _ndjson_lines(records)
+    return _chunked(lines)
@@ -0,0 +1,40 @@
+# data_generations counts the writes to each day's detections. Every insert, update or delete
+# bumps the generation of the day it touches in the same transaction, so the web UI can keep
+# pages and query results for a day until its generation changes. Past days are rarely
+# written to, so theirs are cached for as long as there is room. The '*' row is bumped by bulk
+# jobs that rewrite data without going through the detection write path, and invalidates
+# every day at once.
+
+ALL_DATES = '*'
+
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS data_generations (
+            detection_date TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def bump(cursor, *dates):
+    for detection_date in set(dates):
+        cursor.execute("""
+            INSERT INTO data_generations (detection_date, generation) VALUES (?, 1)
+            ON CONFLICT (detection_date) DO UPDATE SET generation = generation + 1
+        """, (detection_date,))
+
+
+def bump_all(cursor):
+    bump(cursor, ALL_DATES)
+
+
+def get_generation(cursor, start_date, end_date=None):
+    """Returns a number that changes whenever a day between the dates, inclusive, is written to.
+
+    Generations only grow, so their sum over the range changes when any one of them does.
+    """
+    return cursor.execute("""
+        SELECT COALESCE(SUM(generation), 0) FROM data_generations
+        WHERE detection_date BETWEEN ? AND ? OR detection_date = ?
+    """, (start_date, end_date or start_date, ALL_DATES)).fetchone()[0]
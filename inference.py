@@ -0,0 +1,262 @@
+import json
+import queue
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from concurrent.futures import Future
+
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter, load_delegate
+except ImportError:
+    import tensorflow as tf
+    Interpreter = tf.lite.Interpreter
+    load_delegate = tf.lite.experimental.load_delegate
+
+# the Edge TPU runtime that ships with the Coral USB and PCIe accelerators
+EDGETPU_LIBRARY = 'libedgetpu.so.1'
+
+# same fields as the tflite_support Category objects the rest of the app already uses
+Category = namedtuple('Category', ['index', 'score', 'display_name', 'category_name'])
+
+
+def load_labels(model_path):
+    """Reads the label files packed into the model's metadata.
+
+    TFLite models with metadata are also zip files. The english display names live in the
+    '-en' locale file and the category names in the plain label file.
+    """
+    display_names = None
+    category_names = None
+    with zipfile.ZipFile(model_path) as archive:
+        for name in archive.namelist():
+            if not name.endswith('.txt'):
+                continue
+            labels = archive.read(name).decode('utf-8').splitlines()
+            if name.endswith('-en.txt'):
+                display_names = labels
+            else:
+                category_names = labels
+
+    if category_names is None:
+        category_names = display_names
+    if display_names is None:
+        display_names = category_names
+    if display_names is None:
+        raise ValueError(f"No labels found in model metadata: {model_path}")
+    return display_names, category_names
+
+
+def load_normalization(model_path):
+    """Returns the (mean, std) used for float input models, as described by the model metadata."""
+    try:
+        from tflite_support import metadata
+        displayer = metadata.MetadataDisplayer.with_model_file(model_path)
+        model_metadata = json.loads(displayer.get_metadata_json())
+        input_metadata = model_metadata['subgraph_metadata'][0]['input_tensor_metadata'][0]
+        for unit in input_metadata.get('process_units', []):
+            if unit.get('options_type') == 'NormalizationOptions':
+                options = unit['options']
+                return np.array(options['mean'], dtype=np.float32), np.array(options['std'], dtype=np.float32)
+    except Exception:
+        pass
+    return np.float32(0.0), np.float32(1.0)
+
+
+class BatchInterpreter:
+    """Runs batches of up to `max_batch_size` images through a TFLite model.
+
+    Resizing an interpreter's input reallocates all of its tensors, so rather than resizing
+    one interpreter whenever the batch size changes, each batch size gets its own interpreter,
+    allocated the first time a batch of that size comes along. Larger batches are run in
+    slices.
+
+    With `use_coral` the model runs on a Coral Edge TPU. It must be compiled for it (an
+    `_edgetpu.tflite` file), and since compiled models have a fixed input shape, batches are
+    padded up to the model's own batch size and the scores of the padding are dropped.
+    """
+
+    def __init__(self, model_path, num_threads, use_coral=False, max_batch_size=1):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.use_coral = use_coral
+        self.mean, self.std = load_normalization(model_path)
+        self.interpreters = {}
+        interpreter = self._load()
+        model_batch_size = interpreter.get_input_details()[0]['shape'][0]
+        self.max_batch_size = model_batch_size if use_coral else max(1, int(max_batch_size))
+        _, self.input, self.output = self._allocate(interpreter, model_batch_size if use_coral else 1)
+
+    def _load(self):
+        delegates = [load_delegate(EDGETPU_LIBRARY)] if self.use_coral else None
+        return Interpreter(model_path=self.model_path, num_threads=self.num_threads,
+                           experimental_delegates=delegates)
+
+    def _allocate(self, interpreter, size):
+        input_details = interpreter.get_input_details()[0]
+        if input_details['shape'][0] != size:
+            shape = list(input_details['shape'])
+            shape[0] = size
+            interpreter.resize_tensor_input(input_details['index'], shape)
+        interpreter.allocate_tensors()
+        self.interpreters[size] = (interpreter, interpreter.get_input_details()[0],
+                                   interpreter.get_output_details()[0])
+        return self.interpreters[size]
+
+    def run(self, images):
+        largest = self.max_batch_size
+        if len(images) > largest:
+            return np.concatenate([self.run(images[i:i + largest]) for i in range(0, len(images), largest)])
+
+        size = largest if self.use_coral else len(images)
+        interpreter, input_details, output_details = self.interpreters.get(size) or self._allocate(self._load(), size)
+        batch = np.zeros((size,) + images[0].shape, dtype=images[0].dtype)
+        batch[:len(images)] = images
+
+        dtype = input_details['dtype']
+        if dtype == np.float32:
+            batch = (batch.astype(np.float32) - self.mean) / self.std
+        elif dtype != batch.dtype:
+            # fully integer models (int8 input) need the image quantized with the input parameters
+            scale, zero_point = input_details['quantization']
+            batch = np.round(batch.astype(np.float32) / scale + zero_point)
+            info = np.iinfo(dtype)
+            batch = np.clip(batch, info.min, info.max).astype(dtype)
+
+        interpreter.set_tensor(input_details['index'], batch)
+        interpreter.invoke()
+        scores = interpreter.get_tensor(output_details['index'])[:len(images)]
+
+        if scores.dtype != np.float32:
+            scale, zero_point = output_details['quantization']
+            scores = (scores.astype(np.float32) - zero_point) * scale
+        return scores
+
+
+class InferenceEngine:
+    """Runs classification requests through a pool of interpreters with dynamic micro-batching.
+
+    Callers block in classify() while their image waits to be grouped with other pending images.
+    A worker takes the first waiting image, then collects more for up to `max_batch_wait_ms`
+    or until it has `max_batch_size` of them, runs the batch and hands each caller its result.
+    """
+
+    def __init__(self, model_path, num_threads=4, pool_size=1, max_batch_size=1, max_batch_wait_ms=0,
+                 max_results=1, warmup_runs=1, use_coral=False):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.use_coral = use_coral
+        self.pool_size = max(1, int(pool_size))
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_batch_wait = max(0, max_batch_wait_ms) / 1000
+        self.max_results = max_results
+        self.warmup_runs = warmup_runs
+        self.display_names, self.category_names = load_labels(model_path)
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.images = 0
+        self.inference_time = 0.0
+
+    def start(self):
+        ready = []
+        for i in range(self.pool_size):
+            started = threading.Event()
+            thread = threading.Thread(target=self._run, args=(started,), name=f"inference-{i}", daemon=True)
+            thread.start()
+            ready.append(started)
+        for started in ready:
+            started.wait()
+
+    def classify(self, image):
+        future = Future()
+        self.requests.put((image, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self.requests.get(timeout=remaining))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, started):
+        # each worker owns its interpreter; TFLite interpreters are not safe to share between threads
+        interpreter = BatchInterpreter(self.model_path, self.num_threads, self.use_coral, self.max_batch_size)
+        self._warm_up(interpreter)
+        started.set()
+        while True:
+            batch = self._next_batch()
+            begin = time.monotonic()
+            try:
+                scores = interpreter.run([image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            elapsed = time.monotonic() - begin
+
+            with self.lock:
+                self.batches += 1
+                self.images += len(batch)
+                self.inference_time += elapsed
+
+            for (_, future), row in zip(batch, scores):
+                future.set_result(self._categories(row))
+
+    def _warm_up(self, interpreter):
+        # the first batch of each size pays for allocating its interpreter, and the first invoke()
+        # for delegate setup; pay both here, before start() returns, instead of on the first bird of the day
+        if self.warmup_runs <= 0:
+            return
+        begin = time.monotonic()
+        blank = np.zeros(interpreter.input['shape'][1:], dtype=np.uint8)
+        for size in range(interpreter.max_batch_size, 1, -1):
+            interpreter.run([blank] * size)
+        # single images last: that is the batch a quiet feeder's first event arrives in
+        for _ in range(self.warmup_runs):
+            interpreter.run([blank])
+        print(f"{threading.current_thread().name}: model warm-up took {(time.monotonic() - begin) * 1000:.0f} ms",
+              flush=True)
+
+    def _categories(self, row):
+        top = np.argsort(row)[::-1][:self.max_results]
+        return [Category(index=int(i), score=float(row[i]), display_name=self.display_names[i],
+                         category_name=self.category_names[i]) for i in top]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'images': self.images,
+                'avg_batch_size': self.images / self.batches if self.batches else 0.0,
+                'avg_batch_ms': self.inference_time / self.batches * 1000 if self.batches else 0.0,
+            }
+
+    def format_stats(self):
+        s = self.stats()
+        return (f"inference: batches {s['batches']}, images {s['images']}, "
+                f"avg batch size {s['avg_batch_size']:.2f}, avg batch time {s['avg_batch_ms']:.1f} ms")
+
+
+def build_engine(classification_config):
+    """Creates and starts the engine described by the 'classification' section of config.yml."""
+    engine = InferenceEngine(classification_config['model'],
+                             num_threads=classification_config.get('num_threads', 4),
+                             pool_size=classification_config.get('pool_size', 1),
+                             max_batch_size=classification_config.get('max_batch_size', 1),
+                             max_batch_wait_ms=classification_config.get('max_batch_wait_ms', 0),
+                             max_results=classification_config.get('max_results', 1),
+                             warmup_runs=classification_config.get('warmup_runs', 1),
+                             use_coral=classification_config.get('use_coral', False))
+    engine.start()
+    return engine
@@ -0,0 +1,520 @@
+from datetime import datetime
+import time
+import threading
+import paho.mqtt.client as mqtt
+import yaml
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from queries import get_common_name, get_common_name_stats, reload_common_names
+from pipeline import BLOCK, build_pipeline
+from event_tracker import EventTracker
+from inference import build_engine
+import db
+import generations
+import meta
+import rollups
+from db import DBPATH, Writer
+from change_log import record_change
+from migrations import migrate, split_detection_time
+from sublabels import queue_sublabel, build_dispatcher
+import metrics
+from profiling import EventTrace, build_slow_event_log
+from classification_cache import build_classification_cache
+from preprocess import letterbox, build_debug_writer
+from retention import build_retention_job
+from shards import build_supervisor, camera_threshold
+from catch_up import build_catch_up
+
+engine = None
+config = None
+pipeline = None
+writer = None
+dispatcher = None
+event_tracker = None
+debug_writer = None
+slow_event_log = None
+classification_cache = None
+supervisor = None
+shard_notifications = None
+shard_in_flight = None
+catch_up = None
+frigate_session = None
+fetch_timeout = 15
+firstmessage = True
+
+EVENTS = metrics.counter('whosatmyfeeder_ingest_events', "Frigate event messages by what happened to them",
+                         ['outcome'])
+
+
+def classify(image):
+
+    return engine.classify(image)
+
+
+def on_connect(client, userdata, flags, rc):
+    print("MQTT Connected", flush=True)
+
+    # we are going subscribe to frigate/events and look for bird detections there
+    client.subscribe(config['frigate']['main_topic'] + "/events")
+
+    # fetch whatever happened while we weren't listening
+    if catch_up is not None:
+        catch_up.trigger()
+
+
+def on_disconnect(client, userdata, rc):
+    if rc != 0:
+        print("Unexpected disconnection, trying to reconnect", flush=True)
+        # missed events are caught up on once connected again, so retry soon rather than every minute
+        delay = 1
+        while True:
+            try:
+                client.reconnect()
+                break
+            except Exception as e:
+                print(f"Reconnection failed due to {e}, retrying in {delay} seconds", flush=True)
+                time.sleep(delay)
+                delay = min(60, delay * 2)
+    else:
+        print("Expected disconnection", flush=True)
+
+
+def fetch_snapshot(item):
+    trace, after_data = item
+    frigate_event = after_data['id']
+    frigate_url = config['frigate']['frigate_url']
+    snapshot_url = frigate_url + "/api/events/" + frigate_event + "/snapshot.jpg"
+
+    print("Getting image for event: " + frigate_event, flush=True)
+    print("Here's the URL: " + snapshot_url, flush=True)
+    # Send a GET request to the snapshot_url
+    params = {
+        "crop": 1,
+        "quality": 95
+    }
+    try:
+        with trace.span('fetch'):
+            response = frigate_session.get(snapshot_url, params=params, timeout=fetch_timeout)
+    except requests.RequestException as e:
+        print(f"Error: Could not retrieve the image: {e}", flush=True)
+        EVENTS.inc(outcome='fetch_failed')
+        slow_event_log.finish(trace)
+        return None
+    # Check if the request was successful (HTTP status code 200)
+    if response.status_code != 200:
+        print(f"Error: Could not retrieve the image. Status code: {response.status_code}", flush=True)
+        EVENTS.inc(outcome='fetch_failed')
+        slow_event_log.finish(trace)
+        return None
+
+    return trace, after_data, response.content
+
+
+def classify_snapshot(item):
+    trace, after_data, content = item
+
+    # decode and letterbox straight from the response bytes into this worker's input buffer
+    with trace.span('preprocess'):
+        np_arr = letterbox(content)
+    if debug_writer is not None:
+        debug_writer.maybe_save(after_data['id'], content, np_arr)
+
+    if classification_cache is not None:
+        # repeated frames of a bird sitting still get the result of the first one
+        camera = after_data['camera']
+        with trace.span('classify_cached'):
+            cache_key = classification_cache.key(np_arr)
+            categories = classification_cache.get(camera, cache_key)
+        if categories is not None:
+            EVENTS.inc(outcome='cache_hit')
+            return trace, after_data, categories[0]
+
+    with trace.span('classify'):
+        categories = classify(np_arr)
+    EVENTS.inc(outcome='classified')
+    if classification_cache is not None:
+        classification_cache.put(camera, cache_key, categories)
+    return trace, after_data, categories[0]
+
+
+def drop_event(item):
+    # an event the full pipeline turned away, or pushed out to make room for a newer one
+    trace, after_data = item
+    print("Pipeline is full, dropped event: " + after_data['id'], flush=True)
+    EVENTS.inc(outcome='dropped')
+    slow_event_log.finish(trace)
+
+
+def event_done():
+    # in a shard, tells the supervisor that one fewer of the events it dispatched is unfinished
+    if shard_in_flight is not None:
+        with shard_in_flight.get_lock():
+            shard_in_flight.value -= 1
+
+
+def store_detection(item):
+    trace, after_data, category = item
+    saved = None
+    try:
+        with trace.span('persist'):
+            saved = persist_detection(after_data, category)
+    finally:
+        # the event is finished once its detection is committed, which the writer does in the background
+        if saved is None:
+            slow_event_log.finish(trace)
+        else:
+            saved.add_done_callback(lambda future: slow_event_log.finish(trace))
+    return None
+
+
+def persist_detection(after_data, category):
+    """Queues the detection for the writer and returns its future, or None when there is nothing to store.
+
+    It doesn't wait for the commit, so the writer can group the detections of several events into
+    one transaction. detection_saved() reports the outcome once it is committed.
+    """
+    frigate_event = after_data['id']
+
+    index = category.index
+    score = category.score
+    display_name = category.display_name
+    category_name = category.category_name
+
+    start_time = datetime.fromtimestamp(after_data['start_time'])
+    formatted_start_time = start_time.strftime("%Y-%m-%d %H:%M:%S")
+    detection_date, detection_hour = split_detection_time(start_time)
+    result_text = formatted_start_time + "\n"
+    result_text = result_text + str(category)
+    print(result_text, flush=True)
+
+    # catching up after a restart starts from the newest event processed, stored or not
+    writer.submit(meta.set_max_number, meta.LAST_EVENT_TIME, after_data['start_time'])
+
+    if index == 964:  # 964 is "background"
+        EVENTS.inc(outcome='background')
+        return
+    if score <= camera_threshold(config, after_data['camera']):
+        EVENTS.inc(outcome='below_threshold')
+        return
+
+    row = (formatted_start_time, index, score, display_name, category_name, frigate_event,
+           after_data['camera'], detection_date, detection_hour)
+    sublabel = get_common_name(display_name) if sublabels_enabled() else None
+    saved = writer.submit(save_detection, row, sublabel)
+    saved.add_done_callback(lambda future: detection_saved(frigate_event, sublabel, future))
+    return saved
+
+
+def detection_saved(frigate_event, sublabel, future):
+    # runs on the writer thread, after the commit
+    error = future.exception()
+    if error is not None:
+        print(f"Failed to store detection for event {frigate_event}: {error}", flush=True)
+        EVENTS.inc(outcome='store_failed')
+        return
+    outcome = future.result()
+
+    if outcome == 'inserted':
+        print("No record yet for this event. Stored.", flush=True)
+    elif outcome == 'updated':
+        print("New score is higher. Updated record with higher score.", flush=True)
+    else:
+        print("There is already a record for this event with a higher score.", flush=True)
+        EVENTS.inc(outcome='lower_score')
+        return
+    EVENTS.inc(outcome=outcome)
+
+    # the sublabel was queued with the detection; let the dispatcher know it has work
+    if dispatcher is not None:
+        dispatcher.wake()
+    elif shard_notifications is not None and sublabel is not None:
+        shard_notifications.put_nowait('sublabel')
+
+
+def sublabels_enabled():
+    return config.get('sublabels', {}).get('enabled', True)
+
+
+def save_detection(cursor, row, sublabel):
+    """Inserts a detection, or replaces the stored one when the new score is higher, and queues its sublabel.
+
+    Runs on the writer thread. Returns 'inserted', 'updated' or None when the stored score was higher.
+    """
+    frigate_event = row[5]
+    detection_date, detection_hour, display_name = row[7], row[8], row[3]
+
+    cursor.execute("""
+        SELECT detection_date, detection_hour, display_name FROM detections WHERE frigate_event = ?
+        """, (frigate_event,))
+    existing = cursor.fetchone()
+
+    cursor.execute("""
+        INSERT INTO detections (detection_time, detection_index, score, display_name, category_name,
+        frigate_event, camera_name, detection_date, detection_hour)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (frigate_event) DO UPDATE
+        SET detection_time = excluded.detection_time, detection_index = excluded.detection_index,
+            score = excluded.score, display_name = excluded.display_name,
+            category_name = excluded.category_name, detection_date = excluded.detection_date,
+            detection_hour = excluded.detection_hour
+        WHERE excluded.score > detections.score
+        """, row)
+    if cursor.rowcount == 0:
+        return None
+
+    if sublabel is not None:
+        queue_sublabel(cursor, frigate_event, sublabel)
+
+    new = (detection_date, detection_hour, display_name)
+    if existing is None:
+        rollups.add_detection(cursor, *new)
+        meta.set_min(cursor, meta.EARLIEST_DETECTION_DATE, detection_date)
+        record_change(cursor, frigate_event, 'inserted', new)
+        generations.bump(cursor, detection_date)
+        return 'inserted'
+
+    # the best species for the event may have changed, so move it to its new rollup bucket
+    rollups.move_detection(cursor, existing, new)
+    record_change(cursor, frigate_event, 'updated', new, existing)
+    generations.bump(cursor, detection_date, existing[0])
+    return 'updated'
+
+
+def on_message(client, userdata, message):
+    global firstmessage
+    if not firstmessage:
+
+        # Convert the MQTT payload to a Python dictionary
+        payload_dict = json.loads(message.payload)
+
+        # Extract the 'after' element data and store it in a dictionary
+        after_data = payload_dict.get('after', {})
+        EVENTS.inc(outcome='seen')
+
+        cameras = supervisor.cameras if supervisor is not None else config['frigate']['camera']
+        if after_data['camera'] in cameras and after_data['label'] == 'bird':
+            if event_tracker is not None and not event_tracker.should_classify(payload_dict.get('type'), after_data):
+                EVENTS.inc(outcome='deduplicated')
+                return
+
+            # the heavy lifting happens on the pipeline workers so the MQTT network loop never stalls
+            if supervisor is not None:
+                if not supervisor.dispatch(after_data):
+                    print("Pipeline is full, dropped event: " + after_data['id'], flush=True)
+                    EVENTS.inc(outcome='dropped')
+            else:
+                item = (EventTrace(after_data['id']), after_data)
+                if not pipeline.submit(item):
+                    drop_event(item)
+        else:
+            EVENTS.inc(outcome='filtered')
+
+    else:
+        firstmessage = False
+        print("skipping first message", flush=True)
+
+
+def report_pipeline_stats(interval):
+    while True:
+        time.sleep(interval)
+        if pipeline is not None:
+            print("Pipeline stats:\n" + pipeline.format_stats(), flush=True)
+            print("Inference stats: " + engine.format_stats(), flush=True)
+        if supervisor is not None:
+            print("Shard stats: " + supervisor.format_stats(), flush=True)
+        if catch_up is not None:
+            print("Catch-up stats: " + catch_up.format_stats(), flush=True)
+        if event_tracker is not None:
+            print("Event tracker stats: " + event_tracker.format_stats(), flush=True)
+        if classification_cache is not None:
+            print("Classification cache stats: " + classification_cache.format_stats(), flush=True)
+        if dispatcher is not None:
+            print("Sublabel stats: " + dispatcher.format_stats(), flush=True)
+
+
+def register_ingest_metrics():
+    def stats_samples(stats, label, keys):
+        return [({label: name, 'stat': key}, values[key]) for name, values in stats.items() for key in keys]
+
+    if pipeline is not None:
+        metrics.gauge('whosatmyfeeder_pipeline', "Pipeline stage queue lengths and counters",
+                      lambda: stats_samples(pipeline.stats(), 'stage',
+                                            ['queue_length', 'queue_size', 'processed', 'dropped', 'errors']))
+        metrics.gauge('whosatmyfeeder_inference', "Inference engine batch counters",
+                      lambda: [({'stat': key}, value) for key, value in engine.stats().items()])
+    if supervisor is not None:
+        metrics.gauge('whosatmyfeeder_shards', "Ingest shard processes by camera",
+                      lambda: stats_samples(supervisor.stats(), 'camera',
+                                            ['alive', 'restarts', 'dropped', 'queue_length', 'in_flight',
+                                             'num_threads']))
+    if catch_up is not None:
+        metrics.gauge('whosatmyfeeder_catch_up', "Missed event catch-up counters",
+                      lambda: [({'stat': key}, value) for key, value in catch_up.stats().items()])
+    metrics.gauge('whosatmyfeeder_common_names', "Common name cache counters",
+                  lambda: [({'stat': key}, value) for key, value in get_common_name_stats().items()])
+    metrics.gauge('whosatmyfeeder_db_writer', "Database writer transaction counters",
+                  lambda: [({'stat': key}, value) for key, value in writer.stats().items()])
+    if event_tracker is not None:
+        metrics.gauge('whosatmyfeeder_event_tracker', "Event tracker classification decisions",
+                      lambda: [({'stat': key}, value) for key, value in event_tracker.stats().items()])
+    if classification_cache is not None:
+        metrics.gauge('whosatmyfeeder_classification_cache', "Classification result cache counters",
+                      lambda: [({'stat': key}, value) for key, value in classification_cache.stats().items()])
+    if dispatcher is not None:
+        metrics.gauge('whosatmyfeeder_sublabels', "Sublabel outbox counters",
+                      lambda: [({'stat': key}, value) for key, value in dispatcher.stats().items()])
+
+
+def setupdb():
+    conn = db.connect(DBPATH)
+    migrate(conn)
+    conn.close()
+
+
+def load_config():
+    global config
+    file_path = './config/config.yml'
+    with open(file_path, 'r') as config_file:
+        config = yaml.safe_load(config_file)
+
+
+def start_writer():
+    global writer
+    database_config = config.get('database', {})
+    writer = Writer(DBPATH, max_batch=database_config.get('write_batch_size', 50))
+    writer.start()
+
+
+def start_receiver():
+    """Starts what the MQTT process runs whether or not classification is sharded."""
+    global event_tracker, dispatcher
+    if sublabels_enabled():
+        dispatcher = build_dispatcher(config, writer)
+        dispatcher.start()
+
+    retention_job = build_retention_job(config.get('retention'))
+    if retention_job is not None:
+        retention_job.start()
+
+    tracker_config = config.get('event_tracker', {})
+    if tracker_config.get('enabled', True):
+        event_tracker = EventTracker(window=tracker_config.get('window', 2),
+                                     ttl=tracker_config.get('ttl', 3600))
+
+
+def start_classification():
+    """Loads the model and starts the fetch -> classify -> persist pipeline."""
+    global engine, pipeline, debug_writer, slow_event_log, classification_cache, frigate_session, fetch_timeout
+    slow_event_log = build_slow_event_log(config.get('profiling'))
+    # the model is loaded here, in the process that classifies, so the interpreter threads live where they are used
+    engine = build_engine(config['classification'])
+    debug_writer = build_debug_writer(config.get('debug'))
+    classification_cache = build_classification_cache(config.get('classification_cache'))
+
+    # one keep-alive connection to Frigate per fetch worker
+    fetch_config = config.get('pipeline', {}).get('fetch') or {}
+    fetch_timeout = fetch_config.get('timeout', 15)
+    frigate_session = requests.Session()
+    frigate_session.mount('http://', HTTPAdapter(pool_maxsize=fetch_config.get('workers', 2)))
+    frigate_session.mount('https://', HTTPAdapter(pool_maxsize=fetch_config.get('workers', 2)))
+
+    pipeline = build_pipeline(config.get('pipeline', {}), fetch_snapshot, classify_snapshot, store_detection,
+                              on_drop=drop_event, on_done=event_done)
+    pipeline.start()
+
+
+def start_reporting(export_name, labels):
+    stats_interval = config.get('pipeline', {}).get('stats_interval', 300)
+    if stats_interval:
+        threading.Thread(target=report_pipeline_stats, args=(stats_interval,), daemon=True).start()
+
+    register_ingest_metrics()
+    metrics_config = config.get('metrics', {})
+    metrics.start_exporter(export_name, metrics_config.get('export_interval', 15),
+                           metrics_config.get('path', metrics.METRICS_DIR), labels=labels)
+
+
+def start_pipeline():
+    global supervisor, catch_up
+    start_writer()
+    start_receiver()
+    supervisor = build_supervisor(config, run_shard, on_notification=on_shard_notification)
+    if supervisor is not None:
+        supervisor.start()
+        # the cameras are asked for on every run: rebalancing may have added some
+        catch_up = build_catch_up(config, supervisor.dispatch_missed, supervisor.idle,
+                                  lambda: list(supervisor.cameras))
+    else:
+        start_classification()
+        catch_up = build_catch_up(config, submit_missed_event, pipeline.idle)
+    if catch_up is not None:
+        catch_up.start()
+    start_reporting('ingest', {'process': 'ingest'})
+
+
+def submit_missed_event(after_data):
+    # wait for room rather than evict live events queued ahead of it
+    EVENTS.inc(outcome='caught_up')
+    return pipeline.submit((EventTrace(after_data['id']), after_data), BLOCK)
+
+
+def on_shard_notification(message):
+    if message == 'sublabel' and dispatcher is not None:
+        dispatcher.wake()
+
+
+def run_shard(camera, shard_config, events, notifications, in_flight):
+    """Entry point of a shard process: classifies and stores the events of one camera."""
+    global config, shard_notifications, shard_in_flight
+    config = shard_config
+    shard_notifications = notifications
+    shard_in_flight = in_flight
+    start_writer()
+    start_classification()
+    start_reporting(f'ingest-{camera}', {'process': 'ingest', 'shard': camera})
+    print(f"Shard for camera {camera} is ready", flush=True)
+
+    while True:
+        item = events.get()
+        if item is None:
+            break
+        received, after_data, caught_up = item
+        if caught_up:
+            EVENTS.inc(outcome='caught_up')
+        item = (EventTrace(after_data['id'], started=received), after_data)
+        if not pipeline.submit(item, BLOCK if caught_up else None):
+            drop_event(item)
+    # persist doesn't wait for its transaction, so let the writer commit what is queued too
+    pipeline.join()
+    writer.flush()
+
+
+def run_mqtt_client():
+    start_pipeline()
+    print("Starting MQTT client. Connecting to: " + config['frigate']['mqtt_server'], flush=True)
+    now = datetime.now()
+    current_time = now.strftime("%Y%m%d%H%M%S")
+    client = mqtt.Client("birdspeciesid" + current_time)
+    client.on_message = on_message
+    client.on_disconnect = on_disconnect
+    client.on_connect = on_connect
+    # check if we are using authentication and set username/password if so
+    if config['frigate']['mqtt_auth']:
+        username = config['frigate']['mqtt_username']
+        password = config['frigate']['mqtt_password']
+        client.username_pw_set(username, password)
+
+    client.connect(config['frigate']['mqtt_server'])
+    client.loop_forever()
+
+
+def main():
+    load_config()
+    setupdb()
+    reload_common_names()
+    run_mqtt_client()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import json
+import queue
+import threading
+import time
+
+import db
+from queries import get_detection_changes, get_last_change_id
+
+
+class ChangeFeed:
+    """Follows the detection_changes log and fans new entries out to every open event stream.
+
+    One thread per web process watches `PRAGMA data_version`, which only moves when another
+    connection (the ingest process) commits, and reads the log only then. Each subscriber gets
+    its own bounded queue; a client that falls too far behind is disconnected and catches up
+    from the log when its browser reconnects.
+
+    Each stream holds one of the worker's request threads for as long as the page is open, so
+    at most `max_clients` are served at once, leaving the other threads for ordinary requests.
+    """
+
+    def __init__(self, poll_interval=0.5, client_queue_size=100, max_clients=4):
+        self.poll_interval = poll_interval
+        self.client_queue_size = client_queue_size
+        self.max_clients = max_clients
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.started = False
+        self.last_id = None
+        self.counters = {'published': 0, 'disconnected': 0, 'rejected': 0}
+
+    def subscribe(self):
+        """Returns a queue of new changes, or None when `max_clients` streams are open already."""
+        subscription = queue.Queue(maxsize=self.client_queue_size)
+        with self.lock:
+            if len(self.subscribers) >= self.max_clients:
+                self.counters['rejected'] += 1
+                return None
+            if not self.started:
+                threading.Thread(target=self._run, name="change-feed", daemon=True).start()
+                self.started = True
+            if self.last_id is None:
+                # taken before the caller reads its backlog, so nothing committed in between is missed
+                self.last_id = get_last_change_id()
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def _run(self):
+        conn = db.connect()
+        data_version = None
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with self.lock:
+                    if not self.subscribers:
+                        # nobody is listening; the next subscriber starts again from the end
+                        self.last_id = None
+                        continue
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version != data_version:
+                    self._publish_new()
+                data_version = version
+            except Exception as e:
+                print(f"Change feed error: {e}", flush=True)
+
+    def _publish_new(self):
+        while True:
+            changes = get_detection_changes(self.last_id)
+            for change in changes:
+                self._publish(change)
+                self.last_id = change['id']
+            if len(changes) < 100:
+                return
+
+    def _publish(self, change):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(change)
+            except queue.Full:
+                # tell the stream to end, the browser reconnects with its Last-Event-ID
+                self.unsubscribe(subscription)
+                with subscription.mutex:
+                    subscription.queue.clear()
+                subscription.put_nowait(None)
+                self.counters['disconnected'] += 1
+        self.counters['published'] += 1
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+            result['clients'] = len(self.subscribers)
+        return result
+
+
+def format_event(change):
+    return f"id: {change['id']}\nevent: detection\ndata: {json.dumps(change)}\n\n"
+
+
+def stream(feed, subscription, since, keepalive=15, retry_ms=5000, max_backlog=500):
+    """Yields server-sent events: the changes after `since`, then live ones from `subscription`."""
+    try:
+        yield f"retry: {retry_ms}\n\n"
+        last_sent = since
+        if since is not None:
+            backlog = get_detection_changes(since, limit=max_backlog)
+            if len(backlog) == max_backlog:
+                # too far behind to patch the page, have the browser reload it instead
+                yield "event: reset\ndata: {}\n\n"
+                return
+            for change in backlog:
+                yield format_event(change)
+                last_sent = change['id']
+
+        while True:
+            try:
+                change = subscription.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if change is None:
+                return
+            if last_sent is not None and change['id'] <= last_sent:
+                continue
+            yield format_event(change)
+            last_sent = change['id']
+    finally:
+        feed.unsubscribe(subscription)
+
+
+def build_change_feed(live_config, threads=8):
+    live_config = live_config or {}
+    return ChangeFeed(poll_interval=live_config.get('poll_interval', 0.5),
+                      client_queue_size=live_config.get('client_queue_size', 100),
+                      max_clients=live_config.get('max_streams', max(1, threads // 2)))
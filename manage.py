@@ -0,0 +1,201 @@
+import argparse
+import os
+import sys
+
+import yaml
+
+import db
+import generations
+import meta
+import retention
+import rollups
+from db import DBPATH
+from migrations import migrate
+
+CONFIG_PATH = './config/config.yml'
+
+
+def rebuild_rollups(args):
+    conn = db.connect(DBPATH)
+    migrate(conn)
+    cursor = conn.cursor()
+    rollups.rebuild(cursor, since=meta.get_value(cursor, meta.ARCHIVED_BEFORE))
+    meta.refresh_earliest_detection_date(cursor)
+    generations.bump_all(cursor)
+    conn.commit()
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(count), 0) FROM species_hourly_counts")
+    buckets, detections = cursor.fetchone()
+    conn.close()
+    print(f"Rebuilt {buckets} rollup buckets covering {detections} detections", flush=True)
+    return 0
+
+
+def check_rollups(args):
+    conn = db.connect(DBPATH)
+    migrate(conn)
+    cursor = conn.cursor()
+    mismatches = rollups.check(cursor, since=meta.get_value(cursor, meta.ARCHIVED_BEFORE))
+    conn.close()
+    for detection_date, detection_hour, display_name, rollup_count, actual_count in mismatches:
+        print(f"{detection_date} {detection_hour:02d}:00 {display_name}: rollup has {rollup_count}, "
+              f"detections has {actual_count}", flush=True)
+    if mismatches:
+        print(f"{len(mismatches)} rollup buckets are inconsistent. Run 'python manage.py rebuild-rollups' "
+              f"to fix them.", flush=True)
+        return 1
+    print("Rollups are consistent with detections", flush=True)
+    return 0
+
+
+def archive_detections(args):
+    conn = db.connect(DBPATH)
+    migrate(conn)
+    hot_days = args.hot_days
+    if hot_days is None:
+        hot_days = load_config().get('retention', {}).get('hot_days', 0)
+    if not hot_days:
+        print("Nothing to do: set retention.hot_days in config.yml or pass --hot-days", flush=True)
+        return 1
+    moved = retention.archive(conn, hot_days)
+    conn.close()
+    print(f"Moved {moved} detections older than {hot_days} days to {retention.ARCHIVE_DIR}", flush=True)
+    return 0
+
+
+def compact_database(args):
+    conn = db.connect(DBPATH)
+    size_before = os.path.getsize(DBPATH)
+    if args.full:
+        retention.compact(conn)
+    else:
+        retention.maintain(conn)
+    conn.close()
+    print(f"Database size: {size_before / 1e6:.1f} MB before, {os.path.getsize(DBPATH) / 1e6:.1f} MB after",
+          flush=True)
+    return 0
+
+
+def benchmark_model(args):
+    # imported here so the other commands don't load the model runtime
+    import model_benchmark
+    from queries import load_common_names
+
+    classification_config = load_config()['classification']
+    models = args.models or [classification_config['model']]
+    if args.images:
+        images = model_benchmark.load_images(args.images, args.limit)
+        if not images:
+            print(f"No images found in {args.images}", flush=True)
+            return 1
+    else:
+        print("No --images given, using random images: latency and memory only", flush=True)
+        images = model_benchmark.synthetic_images(args.limit or 50)
+
+    thread_counts = args.threads or sorted({n for n in (1, 2, 4, os.cpu_count() or 1) if n <= (os.cpu_count() or 1)})
+    print(f"Running {len(models) + len(args.coral or ())} model(s) over {len(images)} images with {thread_counts} threads", flush=True)
+    results = model_benchmark.benchmark(models, images, thread_counts, load_common_names(), args.reference,
+                                        args.coral or ())
+    print(model_benchmark.format_report(results), flush=True)
+
+    recommendation = model_benchmark.recommend(results, args.min_agreement)
+    print(f"Recommended: model {recommendation['model']} with num_threads {recommendation['num_threads']}"
+          f"{' on Coral' if recommendation['use_coral'] else ''}", flush=True)
+    if args.write_config:
+        model_benchmark.update_config(CONFIG_PATH, 'classification', recommendation)
+        print(f"Updated the classification section of {CONFIG_PATH}", flush=True)
+    return 0
+
+
+def reclassify_detections(args):
+    # imported here so the other commands don't load the model runtime
+    import reclassify
+
+    config = load_config()
+    if args.threshold is not None:
+        config['classification']['threshold'] = args.threshold
+    model_path = args.model or config['classification']['model']
+    conn = db.connect(DBPATH)
+    migrate(conn)
+    source = reclassify.SnapshotSource(config['frigate']['frigate_url'], args.snapshot_dir, rate=args.rate,
+                                       concurrency=args.concurrency)
+    reclassifier = reclassify.Reclassifier(config, model_path, source, processes=args.processes,
+                                           threads_per_process=args.threads, page_size=args.batch_size,
+                                           dry_run=args.dry_run, delete_rejected=args.delete_rejected,
+                                           report_path=args.report)
+    try:
+        reclassifier.run(conn, restart=args.restart, limit=args.limit)
+    except KeyboardInterrupt:
+        print("Interrupted; run the command again to resume", flush=True)
+        return 1
+    finally:
+        conn.close()
+    print(reclassifier.format_summary(), flush=True)
+    if args.dry_run:
+        print("Dry run: nothing was written", flush=True)
+    return 0
+
+
+def load_config():
+    with open(CONFIG_PATH, 'r') as config_file:
+        return yaml.safe_load(config_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for Who's At My Feeder")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('rebuild-rollups', help="recompute species_hourly_counts from detections") \
+        .set_defaults(func=rebuild_rollups)
+    subparsers.add_parser('check-rollups', help="compare species_hourly_counts with detections") \
+        .set_defaults(func=check_rollups)
+    archive_parser = subparsers.add_parser('archive',
+                                           help="move detections older than the hot window to the archives")
+    archive_parser.add_argument('--hot-days', type=int,
+                                help="days to keep in the main database (default: retention.hot_days)")
+    archive_parser.set_defaults(func=archive_detections)
+    compact_parser = subparsers.add_parser('compact', help="vacuum and analyze the database")
+    compact_parser.add_argument('--full', action='store_true',
+                                help="rewrite the whole database and enable incremental vacuum; stop the app first")
+    compact_parser.set_defaults(func=compact_database)
+    benchmark_parser = subparsers.add_parser('benchmark-model', help="compare .tflite models on this host")
+    benchmark_parser.add_argument('models', nargs='*', help="models to compare (default: classification.model)")
+    benchmark_parser.add_argument('--images', help="folder of bird crops, optionally in one subfolder per species")
+    benchmark_parser.add_argument('--limit', type=int, help="use at most this many images")
+    benchmark_parser.add_argument('--threads', type=int, nargs='+', help="thread counts to try (default: 1 2 4)")
+    benchmark_parser.add_argument('--coral', nargs='+', metavar='MODEL',
+                                  help="Edge TPU compiled models to run on a Coral accelerator")
+    benchmark_parser.add_argument('--reference', help="model the others are compared with (default: the first)")
+    benchmark_parser.add_argument('--min-agreement', type=float, default=0.95,
+                                  help="lowest top-1 agreement with the reference to recommend a model")
+    benchmark_parser.add_argument('--write-config', action='store_true',
+                                  help="save the recommended model, num_threads and use_coral to config.yml")
+    benchmark_parser.set_defaults(func=benchmark_model)
+
+    reclassify_parser = subparsers.add_parser('reclassify',
+                                              help="run stored detections through the current model and threshold")
+    reclassify_parser.add_argument('--model', help="model to use (default: classification.model)")
+    reclassify_parser.add_argument('--threshold', type=float,
+                                   help="score threshold (default: classification.threshold)")
+    reclassify_parser.add_argument('--snapshot-dir',
+                                   help="folder of saved snapshots to use before asking Frigate, e.g. Frigate's clips")
+    reclassify_parser.add_argument('--rate', type=float, default=5, help="most snapshot requests to Frigate per second")
+    reclassify_parser.add_argument('--concurrency', type=int, default=4, help="snapshots fetched at the same time")
+    reclassify_parser.add_argument('--processes', type=int, help="classification processes (default: one per core)")
+    reclassify_parser.add_argument('--threads', type=int, default=1, help="interpreter threads per process")
+    reclassify_parser.add_argument('--batch-size', type=int, default=64,
+                                   help="detections classified and written per transaction")
+    reclassify_parser.add_argument('--limit', type=int, help="stop after this many detections")
+    reclassify_parser.add_argument('--dry-run', action='store_true', help="report what would change without writing")
+    reclassify_parser.add_argument('--report', help="write every change to this CSV file")
+    reclassify_parser.add_argument('--delete-rejected', action='store_true',
+                                   help="delete detections that are now background or below the threshold")
+    reclassify_parser.add_argument('--restart', action='store_true',
+                                   help="start from the first detection instead of resuming")
+    reclassify_parser.set_defaults(func=reclassify_detections)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import uuid
+
+import requests
+from flask import Response, abort, request, send_from_directory
+from requests.adapters import HTTPAdapter
+
+from metrics import counter, histogram
+
+# Frigate event ids look like 1690000000.123456-abc123; anything else is never used as a file name
+EVENT_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]+$')
+
+CLIP_CHUNK_SIZE = 64 * 1024
+
+PROXY_FETCH_SECONDS = histogram('whosatmyfeeder_proxy_fetch_seconds', "Time to fetch media from Frigate", ['kind'])
+PROXY_REQUESTS = counter('whosatmyfeeder_proxy_requests', "Thumbnail and snapshot requests by cache result",
+                         ['kind', 'cache'])
+
+# headers passed through from Frigate when streaming a clip
+CLIP_HEADERS = ['Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges', 'Last-Modified']
+
+
+class DiskCache:
+    """A size-bounded directory of cached files, evicting the least recently used first.
+
+    Recency is tracked with file modification times, which are bumped on every hit, so the
+    cache survives restarts and can be shared by several web worker processes.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, name):
+        path = os.path.join(self.path, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, name, data):
+        path = os.path.join(self.path, name)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # rescan rather than trusting self.size, since other processes may share the directory
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self.size = total
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self.size}
+
+
+class MediaProxy:
+    """Serves Frigate thumbnails, snapshots and clips to the browser.
+
+    All requests to Frigate share one pooled session with explicit timeouts, and at most
+    `max_concurrent_requests` of them run at once. Thumbnails and snapshots never change for
+    an event id, so they are cached on disk and sent with a long-lived Cache-Control header.
+    Clips are streamed in chunks and Range requests are passed through so seeking works.
+    """
+
+    def __init__(self, frigate_url, cache_dir='./data/cache', cache_max_mb=200, connect_timeout=3,
+                 read_timeout=15, max_concurrent_requests=8):
+        self.frigate_url = frigate_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.slots = threading.BoundedSemaphore(max_concurrent_requests)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_requests)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = DiskCache(cache_dir, cache_max_mb * 1024 * 1024)
+
+    def _acquire(self):
+        if not self.slots.acquire(timeout=self.timeout[1]):
+            print("Too many concurrent requests to Frigate", flush=True)
+            abort(503)
+
+    @staticmethod
+    def _check_event_id(frigate_event):
+        if not EVENT_ID_PATTERN.match(frigate_event):
+            abort(404)
+
+    @staticmethod
+    def _placeholder():
+        # Return the single transparent pixel image from the local file if the actual image is not found
+        response = send_from_directory('static/images', '1x1.png', mimetype='image/png')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def image(self, frigate_event, kind):
+        """Returns thumbnail.jpg or snapshot.jpg for an event, from the cache when possible."""
+        self._check_event_id(frigate_event)
+        etag = f'"{frigate_event}-{kind}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            return self._image_response(None, etag, status=304)
+
+        name = f"{frigate_event}-{kind}.jpg"
+        data = self.cache.get(name)
+        PROXY_REQUESTS.inc(kind=kind, cache='miss' if data is None else 'hit')
+        if data is None:
+            self._acquire()
+            try:
+                with PROXY_FETCH_SECONDS.time(kind=kind):
+                    response = self.session.get(f'{self.frigate_url}/api/events/{frigate_event}/{kind}.jpg',
+                                                timeout=self.timeout)
+            except requests.RequestException as e:
+                print(f"Error fetching {kind} from frigate: {e}", flush=True)
+                abort(500)
+            finally:
+                self.slots.release()
+
+            if response.status_code != 200:
+                return self._placeholder()
+            data = response.content
+            self.cache.put(name, data)
+
+        return self._image_response(data, etag)
+
+    @staticmethod
+    def _image_response(data, etag, status=200):
+        response = Response(data, status=status, mimetype='image/jpeg')
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+    def clip(self, frigate_event):
+        """Streams clip.mp4 for an event, honouring the browser's Range header."""
+        self._check_event_id(frigate_event)
+        headers = {}
+        if 'Range' in request.headers:
+            headers['Range'] = request.headers['Range']
+
+        self._acquire()
+        try:
+            # only the time to the response headers; the body is streamed to the browser afterwards
+            with PROXY_FETCH_SECONDS.time(kind='clip'):
+                response = self.session.get(f'{self.frigate_url}/api/events/{frigate_event}/clip.mp4',
+                                            headers=headers, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.slots.release()
+            print(f"Error fetching clip from frigate: {e}", flush=True)
+            abort(500)
+
+        if response.status_code not in (200, 206):
+            response.close()
+            self.slots.release()
+            return self._placeholder()
+
+        def close():
+            # the slot is held until the browser has the whole range or goes away
+            response.close()
+            self.slots.release()
+
+        passthrough = {header: response.headers[header] for header in CLIP_HEADERS if header in response.headers}
+        passthrough.setdefault('Accept-Ranges', 'bytes')
+        proxied = Response(response.iter_content(chunk_size=CLIP_CHUNK_SIZE), status=response.status_code,
+                           headers=passthrough, direct_passthrough=True)
+        proxied.call_on_close(close)
+        return proxied
+
+
+def build_media_proxy(config):
+    media_config = config.get('media', {})
+    return MediaProxy(config['frigate']['frigate_url'],
+                      cache_dir=media_config.get('cache_dir', './data/cache'),
+                      cache_max_mb=media_config.get('cache_max_mb', 200),
+                      connect_timeout=media_config.get('connect_timeout', 3),
+                      read_timeout=media_config.get('read_timeout', 15),
+                      max_concurrent_requests=media_config.get('max_concurrent_requests', 8))
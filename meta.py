@@ -0,0 +1,52 @@
+# meta is a small key/value table for facts about the database that are expensive to compute
+# from the detections themselves, such as the earliest detection date, or that record where a
+# background job got to.
+
+EARLIEST_DETECTION_DATE = 'earliest_detection_date'
+ARCHIVED_BEFORE = 'archived_before'
+LAST_EVENT_TIME = 'last_event_time'
+
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID
+    """)
+
+
+def get_value(cursor, key, default=None):
+    row = cursor.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row is not None and row[0] is not None else default
+
+
+def set_value(cursor, key, value):
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+    """, (key, value))
+
+
+def set_min(cursor, key, value):
+    """Stores value unless the stored one is smaller already. Values compare as strings."""
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        WHERE meta.value IS NULL OR excluded.value < meta.value
+    """, (key, value))
+
+
+def set_max_number(cursor, key, value):
+    """Stores value unless the stored one is larger already. Values compare as numbers."""
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET value = excluded.value
+        WHERE meta.value IS NULL OR CAST(excluded.value AS REAL) > CAST(meta.value AS REAL)
+    """, (key, value))
+
+
+def refresh_earliest_detection_date(cursor):
+    # the rollup keeps counts for archived days too, so its first day is the first day with data
+    earliest = cursor.execute("SELECT MIN(detection_date) FROM species_hourly_counts").fetchone()[0]
+    set_value(cursor, EARLIEST_DETECTION_DATE, earliest)
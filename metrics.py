@@ -0,0 +1,257 @@
+import atexit
+import bisect
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics are kept in plain Python objects and rendered in the Prometheus text format by the
+# web UI's /metrics route. The ingest process periodically exports its registry as JSON to
+# METRICS_DIR, and the web process merges those files into its own output, so one scrape
+# covers both processes.
+
+METRICS_DIR = './data/metrics'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# exported files that haven't been refreshed for this long belong to a process that is gone
+STALE_EXPORT_SECONDS = 600
+
+# the name and labels this process exports under, so render() labels its own samples the same
+# way and doesn't merge its own export a second time
+_own_export = (None, None)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {sorted(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock:
+            samples = [(self.name + '_total', dict(zip(self.labelnames, key)), value)
+                       for key, value in self.values.items()]
+        return {'type': 'counter', 'help': self.documentation, 'samples': samples}
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        samples = []
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        for key, counts in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((self.name + '_bucket', dict(labels, le=le), cumulative))
+            samples.append((self.name + '_count', labels, cumulative))
+            samples.append((self.name + '_sum', labels, counts[-1]))
+        return {'type': 'histogram', 'help': self.documentation, 'samples': samples}
+
+
+class Gauge:
+    """A gauge whose samples come from a callback when metrics are collected.
+
+    The callback returns a list of (labels dict, value) pairs, which lets existing stats()
+    methods (pipeline queues, caches, ...) be exposed without keeping a second copy of them.
+    """
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def collect(self):
+        try:
+            samples = [(self.name, labels, value) for labels, value in self.callback()]
+        except Exception as e:
+            print(f"Failed to collect {self.name}: {e}", flush=True)
+            samples = []
+        return {'type': 'gauge', 'help': self.documentation, 'samples': samples}
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback):
+        # callbacks are replaced rather than kept, so a restarted component reports itself
+        with self.lock:
+            self.metrics[name] = Gauge(name, documentation, callback)
+            return self.metrics[name]
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.collect() for metric in metrics}
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+
+def timed(metric, **labels):
+    """Decorator that observes the duration of every call in a histogram."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metric.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _add_labels(families, labels):
+    if not labels:
+        return families
+    return {name: dict(family, samples=[(sample, dict(sample_labels, **labels), value)
+                                        for sample, sample_labels, value in family['samples']])
+            for name, family in families.items()}
+
+
+def export(name, path=METRICS_DIR, labels=None):
+    """Writes this process's metrics to <path>/<name>.json for the web process to pick up."""
+    os.makedirs(path, exist_ok=True)
+    target = os.path.join(path, name + '.json')
+    temp_path = target + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(_add_labels(REGISTRY.collect(), labels), f)
+    os.replace(temp_path, target)
+
+
+def _remove_export(file_path):
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
+
+def start_exporter(name, interval, path=METRICS_DIR, labels=None):
+    global _own_export
+    _own_export = (name, labels)
+    # a process that exits cleanly takes its export with it instead of leaving it to go stale
+    atexit.register(_remove_export, os.path.join(path, name + '.json'))
+
+    def run():
+        while True:
+            try:
+                export(name, path, labels)
+            except Exception as e:
+                print(f"Failed to export metrics: {e}", flush=True)
+            time.sleep(interval)
+
+    threading.Thread(target=run, name="metrics-exporter", daemon=True).start()
+
+
+def _load_exports(path):
+    now = time.time()
+    own_file = _own_export[0] + '.json' if _own_export[0] else None
+    for file_path in sorted(glob.glob(os.path.join(path, '*.json'))):
+        if os.path.basename(file_path) == own_file:
+            continue
+        try:
+            if now - os.path.getmtime(file_path) > STALE_EXPORT_SECONDS:
+                continue
+            with open(file_path) as f:
+                yield json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+def render(path=METRICS_DIR):
+    """Renders this process's metrics merged with every exported file, in the Prometheus text format."""
+    families = {}
+    own = _add_labels(REGISTRY.collect(), _own_export[1])
+    for source in [own] + list(_load_exports(path)):
+        for name, family in source.items():
+            merged = families.setdefault(name, {'type': family['type'], 'help': family['help'], 'samples': []})
+            merged['samples'].extend(family['samples'])
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for sample, labels, value in family['samples']:
+            if labels:
+                label_text = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+                lines.append(f"{sample}{{{label_text}}} {_format_value(value)}")
+            else:
+                lines.append(f"{sample} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
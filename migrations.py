@@ -0,0 +1,122 @@
+import change_log
+import generations
+import meta
+import rollups
+import sublabels
+
+# Each migration runs once, in order, inside its own transaction. The schema version of a
+# database is kept in PRAGMA user_version, so databases created before migrations existed
+# (version 0, but possibly with a detections table) are brought up to date in place.
+
+
+def create_detections(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS detections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            detection_time TIMESTAMP NOT NULL,
+            detection_index INTEGER NOT NULL,
+            score REAL NOT NULL,
+            display_name TEXT NOT NULL,
+            category_name TEXT NOT NULL,
+            frigate_event TEXT NOT NULL UNIQUE,
+            camera_name TEXT NOT NULL
+        )
+    """)
+
+
+def add_date_columns(cursor):
+    # filtering on DATE(detection_time) or strftime() can't use an index, so the date and hour
+    # are stored in their own columns that the queries compare against directly
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(detections)")]
+    if 'detection_date' not in columns:
+        cursor.execute("ALTER TABLE detections ADD COLUMN detection_date TEXT")
+    if 'detection_hour' not in columns:
+        cursor.execute("ALTER TABLE detections ADD COLUMN detection_hour INTEGER")
+
+    cursor.execute("""
+        UPDATE detections
+        SET detection_date = substr(detection_time, 1, 10),
+            detection_hour = CAST(substr(detection_time, 12, 2) AS INTEGER)
+        WHERE detection_date IS NULL OR detection_hour IS NULL
+    """)
+
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_detections_date_name
+        ON detections (detection_date, display_name, detection_hour)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_detections_name_date
+        ON detections (display_name, detection_date)
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_detections_time ON detections (detection_time)")
+    cursor.execute("ANALYZE")
+
+
+def add_hourly_rollup(cursor):
+    rollups.create_table(cursor)
+    rollups.rebuild(cursor)
+
+
+def add_sublabel_outbox(cursor):
+    sublabels.create_table(cursor)
+
+
+def add_change_log(cursor):
+    change_log.create_table(cursor)
+
+
+def add_meta(cursor):
+    meta.create_table(cursor)
+    meta.refresh_earliest_detection_date(cursor)
+
+
+def add_data_generations(cursor):
+    generations.create_table(cursor)
+
+
+MIGRATIONS = [
+    create_detections,
+    add_date_columns,
+    add_hourly_rollup,
+    add_sublabel_outbox,
+    add_change_log,
+    add_meta,
+    add_data_generations,
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Applies any migrations the database hasn't seen yet. Returns the resulting schema version."""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        version = schema_version(conn)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            cursor = conn.cursor()
+            # the ingest and web processes may start together; IMMEDIATE makes the second one wait
+            # for the first one's migration and then find it already applied
+            cursor.execute("BEGIN IMMEDIATE")
+            if schema_version(conn) >= number:
+                cursor.execute("COMMIT")
+                continue
+            print(f"Migrating database to version {number}: {migration.__name__}", flush=True)
+            try:
+                migration(cursor)
+                cursor.execute(f"PRAGMA user_version = {number}")
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        return schema_version(conn)
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def split_detection_time(detection_time):
+    """Returns the detection_date and detection_hour column values for a detection datetime."""
+    return detection_time.strftime('%Y-%m-%d'), detection_time.hour
+
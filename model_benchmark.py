@@ -0,0 +1,203 @@
+import os
+import re
+import resource
+import time
+
+import numpy as np
+
+from inference import BatchInterpreter, load_labels
+from preprocess import letterbox
+
+# Used by `manage.py benchmark-model` to compare .tflite variants on this host: how fast each
+# one is at each thread count, how much memory it takes, and how often it picks the same
+# species as the reference model (and the right one, for crops sorted into labeled folders).
+# Models compiled for a Coral Edge TPU are run on it, once, since the thread count barely
+# matters there.
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_images(path, limit=None):
+    """Returns [(label, image)] for the crops under `path`.
+
+    Crops in a subfolder are labeled with the folder's name, which may be a scientific or a
+    common name. Crops directly in `path` are unlabeled.
+    """
+    images = []
+    for root, _, files in sorted(os.walk(path)):
+        label = None if os.path.samefile(root, path) else os.path.basename(root)
+        for name in sorted(files):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            with open(os.path.join(root, name), 'rb') as f:
+                images.append((label, letterbox(f.read(), out=np.zeros((224, 224, 3), dtype=np.uint8))))
+            if limit is not None and len(images) >= limit:
+                return images
+    return images
+
+
+def synthetic_images(count):
+    rng = np.random.default_rng(0)
+    return [(None, rng.integers(0, 256, (224, 224, 3), dtype=np.uint8)) for _ in range(count)]
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_variant(model_path, num_threads, images, warmup_runs=3, use_coral=False):
+    """Classifies every image one at a time. Returns latencies, top-1 indexes and memory used."""
+    before = rss_mb()
+    interpreter = BatchInterpreter(model_path, num_threads, use_coral)
+    for _ in range(warmup_runs):
+        interpreter.run([images[0][1]])
+    memory = rss_mb() - before
+
+    latencies = []
+    top1 = []
+    start = time.perf_counter()
+    for _, image in images:
+        begin = time.perf_counter()
+        scores = interpreter.run([image])
+        latencies.append(time.perf_counter() - begin)
+        top1.append(int(np.argmax(scores[0])))
+    elapsed = time.perf_counter() - start
+    return {
+        'threads': num_threads,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'images_per_second': len(images) / elapsed,
+        'memory_mb': memory,
+        'top1': top1,
+    }
+
+
+def label_matches(label, display_name, common_names):
+    wanted = label.strip().lower()
+    return wanted in (display_name.lower(), common_names.get(display_name, '').lower())
+
+
+def benchmark(models, images, thread_counts, common_names, reference=None, coral_models=()):
+    """Runs every model at every thread count, and every Coral model on the Edge TPU.
+
+    Returns one result per model, reference model first. Coral models that can't be loaded,
+    e.g. because no accelerator is attached, are left out.
+    """
+    reference = reference or models[0]
+    variants = [(reference, False)] + [(model, False) for model in models if model != reference]
+    variants += [(model, True) for model in coral_models]
+    labeled = [label for label, _ in images]
+    results = []
+    for model_path, use_coral in variants:
+        try:
+            display_names, _ = load_labels(model_path)
+        except (ValueError, OSError):
+            # quantized builds are often exported without metadata; they share the reference's labels
+            display_names = results[0]['display_names'] if results else None
+        if use_coral:
+            try:
+                runs = [run_variant(model_path, min(thread_counts), images, use_coral=True)]
+            except (ValueError, OSError) as e:
+                # no Edge TPU runtime, or no accelerator attached
+                print(f"Skipping {model_path} on Coral: {e}", flush=True)
+                continue
+        else:
+            runs = [run_variant(model_path, threads, images) for threads in thread_counts]
+        top1 = runs[0]['top1']
+        result = {
+            'model': model_path,
+            'use_coral': use_coral,
+            'size_mb': os.path.getsize(model_path) / 1e6,
+            'runs': runs,
+            'top1': top1,
+            'display_names': display_names,
+        }
+        if results:
+            reference_top1 = results[0]['top1']
+            result['agreement'] = sum(a == b for a, b in zip(top1, reference_top1)) / len(top1)
+        else:
+            result['agreement'] = 1.0
+        if display_names is not None and any(labeled):
+            pairs = [(label, index) for label, index in zip(labeled, top1) if label]
+            result['accuracy'] = sum(label_matches(label, display_names[index], common_names)
+                                     for label, index in pairs) / len(pairs)
+        results.append(result)
+    return results
+
+
+def recommend(results, min_agreement=0.95, min_speedup=1.05):
+    """Picks the fastest model that agrees with the reference often enough, and its thread count.
+
+    More threads are only recommended when they are at least `min_speedup` times faster, so
+    small hosts aren't told to tie up every core for a few percent.
+    """
+    best = None
+    for result in results:
+        if result['agreement'] < min_agreement:
+            continue
+        if 'accuracy' in result and result['accuracy'] < results[0].get('accuracy', 0) - (1 - min_agreement):
+            continue
+        runs = sorted(result['runs'], key=lambda run: run['threads'])
+        choice = runs[0]
+        for run in runs[1:]:
+            if run['images_per_second'] >= choice['images_per_second'] * min_speedup:
+                choice = run
+        if best is None or choice['images_per_second'] > best[1]['images_per_second']:
+            best = (result, choice)
+    result, run = best
+    return {'model': result['model'], 'num_threads': run['threads'], 'use_coral': result['use_coral']}
+
+
+def format_report(results):
+    lines = []
+    for result in results:
+        device = 'Coral' if result['use_coral'] else 'CPU'
+        summary = (f"{result['model']} on {device} ({result['size_mb']:.1f} MB): "
+                   f"top-1 agreement {result['agreement']:.1%}")
+        if 'accuracy' in result:
+            summary += f", accuracy on labeled crops {result['accuracy']:.1%}"
+        lines.append(summary)
+        lines.append(f"  {'threads':>7}{'p50':>10}{'p90':>10}{'p99':>10}{'images/s':>10}{'memory':>10}")
+        for run in result['runs']:
+            lines.append(f"  {run['threads']:>7}{run['p50_ms']:>8.1f}ms{run['p90_ms']:>8.1f}ms{run['p99_ms']:>8.1f}ms"
+                         f"{run['images_per_second']:>10.1f}{run['memory_mb']:>8.1f}MB")
+    return '\n'.join(lines)
+
+
+def update_config(path, section, values):
+    """Sets keys of one top-level section of config.yml in place, leaving the rest of the file as written."""
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    start = next((i for i, line in enumerate(lines) if line.rstrip() == f'{section}:'), None)
+    if start is None:
+        lines.append(f'{section}:')
+        start = len(lines) - 1
+    end = next((i for i in range(start + 1, len(lines)) if lines[i] and not lines[i].startswith((' ', '#'))),
+               len(lines))
+
+    for key, value in values.items():
+        if isinstance(value, bool):
+            value = str(value).lower()
+        pattern = re.compile(rf'^(\s+){re.escape(key)}:')
+        for i in range(start + 1, end):
+            match = pattern.match(lines[i])
+            if match:
+                lines[i] = f'{match.group(1)}{key}: {value}'
+                break
+        else:
+            lines.insert(end, f'  {key}: {value}')
+            end += 1
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,96 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import db
+import generations
+import meta
+from db import DBPATH
+
+# Each web worker keeps rendered pages and JSON query results in memory, tagged with the data
+# generations they were built from (see generations.py), and serves them again until those
+# change. Checking is cheap: SQLite's data_version tells whether any other connection has
+# committed since the last look, and only then are the generations read again. The cache is
+# bounded by the total size of the bodies it holds and evicts the least recently used ones.
+
+# when the data doesn't change for a while, date ranges looked up since are kept up to this many
+MAX_VERSIONS = 1024
+
+
+class PageCache:
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, path=DBPATH):
+        self.max_bytes = max_bytes
+        self.conn = db.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.data_version = None
+        # generations and other small facts read since data_version last changed
+        self.versions = {}
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'revalidations': 0}
+
+    def _version(self, key, compute):
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self.data_version:
+                self.data_version = data_version
+                self.versions.clear()
+                self.counters['revalidations'] += 1
+            if key not in self.versions:
+                if len(self.versions) >= MAX_VERSIONS:
+                    self.versions.clear()
+                self.versions[key] = compute(self.conn)
+            return self.versions[key]
+
+    def generation(self, start_date, end_date=None):
+        end_date = end_date or start_date
+        return self._version(('generation', start_date, end_date),
+                             lambda conn: generations.get_generation(conn, start_date, end_date))
+
+    def earliest_date(self):
+        return self._version('earliest_date',
+                             lambda conn: meta.get_value(conn, meta.EARLIEST_DETECTION_DATE))
+
+    def last_change_id(self):
+        return self._version('last_change_id', lambda conn: conn.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM detection_changes").fetchone()[0])
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, version, body):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (version, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.counters['evictions'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.size)
+
+
+def etag(key, version):
+    return hashlib.blake2b(repr((key, version)).encode(), digest_size=12).hexdigest()
+
+
+def build_page_cache(webui_config):
+    max_mb = (webui_config or {}).get('page_cache_mb', 32)
+    if not max_mb:
+        return None
+    return PageCache(int(max_mb * 1024 * 1024))
@@ -0,0 +1,203 @@
+import queue
+import threading
+import time
+
+# what to do when an event arrives and the entry queue is already full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+
+
+class StageStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.wait_time = 0.0
+        self.busy_time = 0.0
+        self.max_busy_time = 0.0
+
+    def snapshot(self):
+        with self.lock:
+            processed = self.processed
+            return {
+                'submitted': self.submitted,
+                'processed': processed,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'avg_wait_ms': (self.wait_time / processed * 1000) if processed else 0.0,
+                'avg_latency_ms': (self.busy_time / processed * 1000) if processed else 0.0,
+                'max_latency_ms': self.max_busy_time * 1000,
+            }
+
+
+class Stage:
+    """One step of the ingest pipeline: a bounded queue drained by a pool of worker threads.
+
+    The stage function receives an item and returns the item for the next stage, or None
+    when processing of that item should stop here. `on_drop` is called with every item the
+    drop_oldest policy discards to make room. `on_done` is called whenever an item leaves the
+    pipeline here, however that happens.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=10, policy=BLOCK, on_drop=None):
+        self.name = name
+        self.func = func
+        self.on_drop = on_drop
+        self.on_done = None
+        self.workers = max(1, int(workers))
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.next_stage = None
+        self.stats = StageStats()
+        self.threads = []
+
+    def put(self, item, policy=None):
+        """Queues an item, applying `policy`, or the stage's own policy, when the queue is full."""
+        policy = policy or self.policy
+        entry = (time.monotonic(), item)
+        with self.stats.lock:
+            self.stats.submitted += 1
+
+        if policy == BLOCK:
+            self.queue.put(entry)
+            return True
+
+        while True:
+            try:
+                self.queue.put_nowait(entry)
+                return True
+            except queue.Full:
+                if policy == DROP_NEWEST:
+                    self._count_drop()
+                    self._done()
+                    return False
+                # DROP_OLDEST: make room by discarding the item that has waited the longest
+                try:
+                    _, evicted = self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self.queue.task_done()
+                self._count_drop()
+                if self.on_drop is not None:
+                    self.on_drop(evicted)
+                self._done()
+
+    def _count_drop(self):
+        with self.stats.lock:
+            self.stats.dropped += 1
+
+    def _run(self):
+        while True:
+            enqueued, item = self.queue.get()
+            started = time.monotonic()
+            try:
+                result = self.func(item)
+            except Exception as e:
+                result = None
+                with self.stats.lock:
+                    self.stats.errors += 1
+                print(f"Pipeline stage {self.name} failed: {e}", flush=True)
+            finished = time.monotonic()
+
+            with self.stats.lock:
+                self.stats.processed += 1
+                self.stats.wait_time += started - enqueued
+                self.stats.busy_time += finished - started
+                self.stats.max_busy_time = max(self.stats.max_busy_time, finished - started)
+
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(result)
+            else:
+                self._done()
+            self.queue.task_done()
+
+    def _done(self):
+        if self.on_done is not None:
+            self.on_done()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+class Pipeline:
+    """Chains stages so the output of each one is fed to the next.
+
+    Only the entry stage applies the configured drop policy. Inner stages block when full,
+    which pushes backpressure up to the entry queue instead of losing work that was already
+    fetched or classified. `on_done` is called once for every submitted item, when it is
+    stored, stops early, fails or is dropped.
+    """
+
+    def __init__(self, stages, on_done=None):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+        for stage in stages:
+            stage.on_done = on_done
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def submit(self, item, policy=None):
+        return self.stages[0].put(item, policy)
+
+    def idle(self):
+        # unfinished_tasks also counts the items a worker is still processing, not only queued ones
+        return all(stage.queue.unfinished_tasks == 0 for stage in self.stages)
+
+    def join(self):
+        for stage in self.stages:
+            stage.queue.join()
+
+    def stats(self):
+        result = {}
+        for stage in self.stages:
+            stage_stats = stage.stats.snapshot()
+            stage_stats['queue_length'] = stage.queue.qsize()
+            stage_stats['queue_size'] = stage.queue.maxsize
+            result[stage.name] = stage_stats
+        return result
+
+    def format_stats(self):
+        lines = []
+        for name, s in self.stats().items():
+            lines.append(f"{name}: queue {s['queue_length']}/{s['queue_size']}, processed {s['processed']}, "
+                         f"dropped {s['dropped']}, errors {s['errors']}, avg wait {s['avg_wait_ms']:.1f} ms, "
+                         f"avg latency {s['avg_latency_ms']:.1f} ms, max latency {s['max_latency_ms']:.1f} ms")
+        return "\n".join(lines)
+
+
+def build_pipeline(pipeline_config, fetch, classify, persist, on_drop=None, on_done=None):
+    """Builds the fetch -> classify -> persist pipeline from the 'pipeline' section of config.yml.
+
+    `on_drop` is called with each event the entry stage discards to make room for a newer one,
+    and `on_done` once for each event when the pipeline is finished with it.
+    """
+    pipeline_config = pipeline_config or {}
+    policy = pipeline_config.get('drop_policy', DROP_OLDEST)
+    if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+        raise ValueError(f"Unknown pipeline drop_policy: {policy}")
+
+    defaults = {
+        'fetch': {'workers': 2, 'queue_size': 50},
+        'classify': {'workers': 1, 'queue_size': 10},
+        'persist': {'workers': 1, 'queue_size': 50},
+    }
+    funcs = {'fetch': fetch, 'classify': classify, 'persist': persist}
+
+    stages = []
+    for name in ('fetch', 'classify', 'persist'):
+        stage_config = dict(defaults[name])
+        stage_config.update(pipeline_config.get(name) or {})
+        stages.append(Stage(name, funcs[name], workers=stage_config['workers'],
+                            queue_size=stage_config['queue_size'],
+                            policy=policy if not stages else BLOCK,
+                            on_drop=on_drop if not stages else None))
+    return Pipeline(stages, on_done)
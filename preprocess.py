@@ -0,0 +1,87 @@
+import os
+import queue
+import random
+import threading
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+INPUT_SIZE = 224
+
+_buffers = threading.local()
+
+
+def input_buffer():
+    """Returns this thread's preallocated model input buffer.
+
+    The buffer is overwritten by the next letterbox() call on the same thread, so it must be
+    fully consumed (classified) before the thread preprocesses another snapshot.
+    """
+    buffer = getattr(_buffers, 'image', None)
+    if buffer is None:
+        buffer = np.zeros((INPUT_SIZE, INPUT_SIZE, 3), dtype=np.uint8)
+        _buffers.image = buffer
+    return buffer
+
+
+def letterbox(data, out=None):
+    """Decodes JPEG bytes and fits them, aspect ratio preserved, into a black 224x224x3 uint8 array."""
+    image = Image.open(BytesIO(data))
+    # let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding instead of decoding
+    # the full-size snapshot and shrinking it afterwards
+    image.draft('RGB', (INPUT_SIZE, INPUT_SIZE))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail((INPUT_SIZE, INPUT_SIZE))
+
+    if out is None:
+        out = input_buffer()
+    width, height = image.size
+    top = (INPUT_SIZE - height) // 2
+    left = (INPUT_SIZE - width) // 2
+    out.fill(0)
+    out[top:top + height, left:left + width] = np.asarray(image)
+    return out
+
+
+class DebugImageWriter:
+    """Saves a sample of snapshots and model inputs to disk from a background thread.
+
+    Images are only queued when the sample hits, and are dropped rather than waited on when the
+    writer falls behind, so enabling this never slows down ingest.
+    """
+
+    def __init__(self, path, sample_rate=1.0, queue_size=10):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.queue = queue.Queue(maxsize=queue_size)
+        os.makedirs(path, exist_ok=True)
+        threading.Thread(target=self._run, name="debug-images", daemon=True).start()
+
+    def maybe_save(self, name, data, image):
+        if random.random() >= self.sample_rate:
+            return
+        try:
+            self.queue.put_nowait((name, data, image.copy()))
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while True:
+            name, data, image = self.queue.get()
+            try:
+                # the snapshot is written as received; only the model input needs encoding
+                with open(os.path.join(self.path, name + "-fullsized.jpg"), 'wb') as f:
+                    f.write(data)
+                Image.fromarray(image).save(os.path.join(self.path, name + "-shrunk.jpg"), format="JPEG")
+            except Exception as e:
+                print(f"Failed to save debug images for {name}: {e}", flush=True)
+
+
+def build_debug_writer(debug_config):
+    debug_config = debug_config or {}
+    if not debug_config.get('save_images', False):
+        return None
+    return DebugImageWriter(debug_config.get('path', './data/debug'),
+                            sample_rate=debug_config.get('sample_rate', 1.0))
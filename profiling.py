@@ -0,0 +1,128 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+import metrics
+
+INGEST_STAGE_SECONDS = metrics.histogram('whosatmyfeeder_ingest_stage_seconds',
+                                         "Time spent in each ingest stage per event", ['stage'])
+INGEST_EVENT_SECONDS = metrics.histogram('whosatmyfeeder_ingest_event_seconds',
+                                         "Time from receiving an event message to finishing with it")
+
+
+class EventTrace:
+    """Timings of one event as it moves through the ingest stages, possibly on several threads."""
+
+    def __init__(self, event_id, started=None):
+        self.event_id = event_id
+        # a shard passes the time the MQTT process received the event, so its queue wait is counted
+        self.started = time.monotonic() if started is None else started
+        self.started_wall = time.time() - (time.monotonic() - self.started)
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            INGEST_STAGE_SECONDS.observe(elapsed, stage=stage)
+            self.spans.append({
+                'stage': stage,
+                'offset_ms': round((start - self.started) * 1000, 2),
+                'duration_ms': round(elapsed * 1000, 2),
+                'thread': threading.current_thread().name,
+            })
+
+
+class StackSampler:
+    """Periodically records the stacks of the ingest worker threads.
+
+    Samples are kept in a ring buffer so a slow event can be explained after the fact with
+    what its threads were doing while it was in flight.
+    """
+
+    def __init__(self, interval_ms=10, max_samples=20000, thread_prefixes=('fetch', 'classify', 'persist', 'inference')):
+        self.interval = interval_ms / 1000
+        self.thread_prefixes = thread_prefixes
+        self.samples = deque(maxlen=max_samples)
+
+    def start(self):
+        threading.Thread(target=self._run, name="stack-sampler", daemon=True).start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            now = time.monotonic()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, '')
+                if ident == own_id or not name.startswith(self.thread_prefixes):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                self.samples.append((now, name, ';'.join(reversed(stack))))
+            time.sleep(self.interval)
+
+    def between(self, start, end, threads, shared_prefixes=()):
+        """Returns folded stacks ("frame;frame;frame": count) sampled within [start, end].
+
+        Only the stacks of `threads` and of threads whose names start with `shared_prefixes` count.
+        """
+        counts = Counter(stack for sampled, name, stack in list(self.samples)
+                         if start <= sampled <= end and (name in threads or name.startswith(shared_prefixes)))
+        return dict(counts.most_common())
+
+
+class SlowEventLog:
+    """Appends a JSON line with the full trace of every event that exceeds the latency budget."""
+
+    def __init__(self, budget_ms, path, sampler=None):
+        self.budget = budget_ms / 1000
+        self.path = path
+        self.sampler = sampler
+        self.lock = threading.Lock()
+
+    def finish(self, trace):
+        now = time.monotonic()
+        total = now - trace.started
+        INGEST_EVENT_SECONDS.observe(total)
+        if self.budget <= 0 or total <= self.budget:
+            return
+
+        record = {
+            'event': trace.event_id,
+            'received': trace.started_wall,
+            'total_ms': round(total * 1000, 2),
+            'budget_ms': round(self.budget * 1000, 2),
+            'spans': trace.spans,
+        }
+        if self.sampler is not None:
+            threads = {span['thread'] for span in trace.spans}
+            # the model runs on the inference engine's threads, which the classify span waits on
+            # and which no span names, so what they did meanwhile is included too
+            record['stacks'] = self.sampler.between(trace.started, now, threads, shared_prefixes=('inference',))
+
+        print(f"Slow event {trace.event_id}: {record['total_ms']} ms", flush=True)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+def build_slow_event_log(profiling_config):
+    profiling_config = profiling_config or {}
+    sampler = None
+    if profiling_config.get('sample_stacks', False):
+        sampler = StackSampler(interval_ms=profiling_config.get('sample_interval_ms', 10))
+        sampler.start()
+    return SlowEventLog(profiling_config.get('slow_event_ms', 0),
+                        profiling_config.get('log_path', './data/slow_events.log'),
+                        sampler)
@@ -1,35 +1,132 @@
+import base64
+import heapq
+import itertools
+import os
 import sqlite3
+import threading
+import time
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
+from types import MappingProxyType
+
+from db import read_connection
+from meta import EARLIEST_DETECTION_DATE
+from metrics import histogram, timed
+from retention import detection_sources
 
-DBPATH = './data/speciesid.db'
 NAMEDBPATH = './birdnames.db'
 
 
-def get_common_name(scientific_name):
-    conn = sqlite3.connect(NAMEDBPATH)
-    cursor = conn.cursor()
+# scientific name -> common name, loaded once from birdnames.db and swapped out wholesale on reload
+_common_names = None
+_common_names_mtime = None
+_common_names_checked = 0.0
+_common_names_lock = threading.Lock()
+_common_name_stats = {'hits': 0, 'misses': 0, 'reloads': 0}
+_missing_names_logged = {}
+
+QUERY_SECONDS = histogram('whosatmyfeeder_db_query_seconds', "Time spent in each queries.py function", ['query'])
 
-    cursor.execute("SELECT common_name FROM birdnames WHERE scientific_name = ?", (scientific_name,))
-    result = cursor.fetchone()
+# how often to look at birdnames.db for changes, and how often to repeat a missing name warning
+NAMES_RELOAD_CHECK_INTERVAL = 60
+MISSING_NAME_LOG_INTERVAL = 3600
 
+
+def load_common_names():
+    conn = sqlite3.connect(NAMEDBPATH)
+    cursor = conn.cursor()
+    cursor.execute("SELECT scientific_name, common_name FROM birdnames")
+    names = MappingProxyType(dict(cursor.fetchall()))
     conn.close()
+    return names
+
+
+def reload_common_names():
+    with _common_names_lock:
+        _reload_common_names()
+
+
+def _reload_common_names():
+    # the caller holds _common_names_lock
+    global _common_names, _common_names_mtime, _common_names_checked
+    mtime = os.path.getmtime(NAMEDBPATH)
+    _common_names = load_common_names()
+    _common_names_mtime = mtime
+    _common_names_checked = time.monotonic()
+    _common_name_stats['reloads'] += 1
+    _missing_names_logged.clear()
+    print(f"Loaded {len(_common_names)} common names from {NAMEDBPATH}", flush=True)
+
+
+def _current_common_names():
+    global _common_names_checked
+    names = _common_names
+    if names is not None and time.monotonic() - _common_names_checked <= NAMES_RELOAD_CHECK_INTERVAL:
+        return names
+    with _common_names_lock:
+        # another thread may have loaded or checked the names while this one waited for the lock
+        now = time.monotonic()
+        if _common_names is None:
+            _reload_common_names()
+        elif now - _common_names_checked > NAMES_RELOAD_CHECK_INTERVAL:
+            _common_names_checked = now
+            if os.path.getmtime(NAMEDBPATH) != _common_names_mtime:
+                _reload_common_names()
+        return _common_names
 
-    if result:
-        return result[0]
-    else:
+
+def get_common_name(scientific_name):
+    common_name = _current_common_names().get(scientific_name)
+    now = time.monotonic()
+    with _common_names_lock:
+        if common_name is not None:
+            _common_name_stats['hits'] += 1
+            return common_name
+
+        _common_name_stats['misses'] += 1
+        last_logged = _missing_names_logged.get(scientific_name)
+        log = last_logged is None or now - last_logged > MISSING_NAME_LOG_INTERVAL
+        if log:
+            _missing_names_logged[scientific_name] = now
+    if log:
         print ("No common name for: " + scientific_name, flush=True)
-        return "No common name found."
+    return "No common name found."
 
 
-def recent_detections(num_detections):
-    conn = sqlite3.connect(DBPATH)
-    cursor = conn.cursor()
+def get_common_name_stats():
+    with _common_names_lock:
+        stats = dict(_common_name_stats)
+        stats['names'] = len(_common_names) if _common_names is not None else 0
+    return stats
 
-    cursor.execute("SELECT * FROM detections ORDER BY detection_time DESC LIMIT ?", (num_detections,))
-    results = cursor.fetchall()
 
-    conn.close()
+def fetchall(query, params=()):
+    with read_connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def fetch_detections(where, params, start_date, end_date, order_by=('detection_time',), limit=None, columns='*'):
+    """Selects detections from the main database and any archives covering the dates.
+
+    The results of each database are merged in `order_by` order, and `limit` applies to each
+    of them and to the merged result.
+    """
+    query = f"SELECT {columns} FROM {{schema}}.detections WHERE {where} ORDER BY {', '.join(order_by)}"
+    if limit is not None:
+        query += " LIMIT ?"
+        params = params + (limit,)
+    with read_connection() as conn:
+        results = [conn.execute(query.format(schema=schema), params).fetchall()
+                   for schema in detection_sources(conn, start_date, end_date)]
+    if len(results) == 1:
+        return results[0]
+    rows = heapq.merge(*results, key=lambda row: tuple(row[column] for column in order_by))
+    return list(itertools.islice(rows, limit))
+
+
+@timed(QUERY_SECONDS, query='recent_detections')
+def recent_detections(num_detections):
+    results = fetchall("SELECT * FROM detections ORDER BY detection_time DESC LIMIT ?", (num_detections,))
 
     formatted_results = []
     for result in results:
@@ -49,28 +146,21 @@ def recent_detections(num_detections):
     return formatted_results
 
 
+@timed(QUERY_SECONDS, query='get_daily_summary')
 def get_daily_summary(date):
     date_str = date.strftime('%Y-%m-%d')
-    conn = sqlite3.connect(DBPATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
 
+    # species_hourly_counts is kept up to date by the ingest path, so no grouping is needed here
     query = '''  
         SELECT display_name,  
-               COUNT(*) AS total_detections,  
-               STRFTIME('%H', detection_time) AS hour,  
-               COUNT(*) AS hourly_detections  
-        FROM (  
-            SELECT *  
-            FROM detections  
-            WHERE DATE(detection_time) = ?  
-        ) AS subquery  
-        GROUP BY display_name, hour  
-        ORDER BY total_detections DESC, display_name, hour  
+               detection_hour AS hour,  
+               count AS hourly_detections  
+        FROM species_hourly_counts  
+        WHERE detection_date = ?  
+        ORDER BY hourly_detections DESC, display_name, hour  
     '''
 
-    cursor.execute(query, (date_str,))
-    rows = cursor.fetchall()
+    rows = fetchall(query, (date_str,))
 
     summary = defaultdict(lambda: {
         'scientific_name': '',
@@ -86,25 +176,13 @@ def get_daily_summary(date):
         summary[display_name]['total_detections'] += row['hourly_detections']
         summary[display_name]['hourly_detections'][int(row['hour'])] = row['hourly_detections']
 
-    conn.close()
     return dict(summary)
 
 
+@timed(QUERY_SECONDS, query='get_records_for_date_hour')
 def get_records_for_date_hour(date, hour):
-    conn = sqlite3.connect(DBPATH)
-    conn.row_factory = sqlite3.Row  # Set the row factory to sqlite3.Row
-    cursor = conn.cursor()
-
-    # The SQL query to fetch records for the given date and hour, sorted by detection_time
-    query = '''    
-        SELECT *    
-        FROM detections    
-        WHERE strftime('%Y-%m-%d', detection_time) = ? AND strftime('%H', detection_time) = ?    
-        ORDER BY detection_time    
-    '''
-
-    cursor.execute(query, (date, str(hour).zfill(2)))
-    records = cursor.fetchall()
+    # Fetch the records for the given date and hour, sorted by detection_time
+    records = fetch_detections("detection_date = ? AND detection_hour = ?", (date, int(hour)), date, date)
 
     # Append the common name for each record
     result = []
@@ -114,26 +192,18 @@ def get_records_for_date_hour(date, hour):
         record_dict['common_name'] = common_name  # Add the 'common_name' key to the record dictionary
         result.append(record_dict)
 
-    conn.close()
-
     return result
 
 
 def get_records_for_scientific_name_and_date(scientific_name, date):
-    conn = sqlite3.connect(DBPATH)
-    conn.row_factory = sqlite3.Row  # Set the row factory to sqlite3.Row
-    cursor = conn.cursor()
+    return get_records_for_scientific_name_and_date_range(scientific_name, date, date)
 
-    # The SQL query to fetch records for the given display_name and date, sorted by detection_time
-    query = '''    
-        SELECT *    
-        FROM detections    
-        WHERE display_name = ? AND strftime('%Y-%m-%d', detection_time) = ?    
-        ORDER BY detection_time    
-    '''
 
-    cursor.execute(query, (scientific_name, date))
-    records = cursor.fetchall()
+@timed(QUERY_SECONDS, query='get_records_for_scientific_name_and_date_range')
+def get_records_for_scientific_name_and_date_range(scientific_name, start_date, end_date):
+    # Fetch the records for the given display_name and dates, sorted by detection_time
+    records = fetch_detections("display_name = ? AND detection_date BETWEEN ? AND ?",
+                               (scientific_name, start_date, end_date), start_date, end_date)
 
     # Append the common name for each record
     result = []
@@ -143,18 +213,219 @@ def get_records_for_scientific_name_and_date(scientific_name, date):
         record_dict['common_name'] = common_name  # Add the 'common_name' key to the record dictionary
         result.append(record_dict)
 
-    conn.close()
-
     return result
 
 
+@timed(QUERY_SECONDS, query='get_earliest_detection_date')
 def get_earliest_detection_date():
-    conn = sqlite3.connect(DBPATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT MIN(date(detection_time)) FROM detections")
-    earliest_date = cursor.fetchone()[0]
-    conn.close()
+    # kept in the meta table by the ingest process, instead of scanning detections on every page load
+    rows = fetchall("SELECT value FROM meta WHERE key = ?", (EARLIEST_DETECTION_DATE,))
+    earliest_date = rows[0][0] if rows else None
     if earliest_date:
         return earliest_date
     else:
         return None
+
+
+# Range queries. Dates are 'YYYY-MM-DD' strings and both ends are inclusive. The counts come from
+# species_hourly_counts, whose primary key starts with detection_date, so a range is one index
+# range scan no matter how many detections it covers.
+
+def _species_filter(scientific_name):
+    if scientific_name is None:
+        return '', ()
+    return ' AND display_name = ?', (scientific_name,)
+
+
+@timed(QUERY_SECONDS, query='get_species_counts')
+def get_species_counts(start_date, end_date):
+    """Returns the detections of each species in the range, with the first and last day it was seen."""
+    rows = fetchall('''
+        SELECT display_name, SUM(count) AS total, MIN(detection_date) AS first_seen,
+               MAX(detection_date) AS last_seen, COUNT(DISTINCT detection_date) AS days
+        FROM species_hourly_counts
+        WHERE detection_date BETWEEN ? AND ?
+        GROUP BY display_name
+        ORDER BY total DESC, display_name
+    ''', (start_date, end_date))
+    return [{
+        'scientific_name': row['display_name'],
+        'common_name': get_common_name(row['display_name']),
+        'total_detections': row['total'],
+        'days_seen': row['days'],
+        'first_seen': row['first_seen'],
+        'last_seen': row['last_seen'],
+    } for row in rows]
+
+
+@timed(QUERY_SECONDS, query='get_daily_histogram')
+def get_daily_histogram(start_date, end_date, scientific_name=None):
+    """Returns [(date, detections)] for every day in the range that had any."""
+    species_clause, species_params = _species_filter(scientific_name)
+    rows = fetchall(f'''
+        SELECT detection_date, SUM(count)
+        FROM species_hourly_counts
+        WHERE detection_date BETWEEN ? AND ?{species_clause}
+        GROUP BY detection_date
+        ORDER BY detection_date
+    ''', (start_date, end_date) + species_params)
+    return [(row[0], row[1]) for row in rows]
+
+
+@timed(QUERY_SECONDS, query='get_hourly_histogram')
+def get_hourly_histogram(start_date, end_date, scientific_name=None):
+    """Returns the detections in each hour of the day, summed over the range, as a list of 24 counts."""
+    species_clause, species_params = _species_filter(scientific_name)
+    rows = fetchall(f'''
+        SELECT detection_hour, SUM(count)
+        FROM species_hourly_counts
+        WHERE detection_date BETWEEN ? AND ?{species_clause}
+        GROUP BY detection_hour
+    ''', (start_date, end_date) + species_params)
+    hours = [0] * 24
+    for hour, count in rows:
+        hours[int(hour)] = count
+    return hours
+
+
+@timed(QUERY_SECONDS, query='get_first_last_seen')
+def get_first_last_seen(scientific_name):
+    """Returns the (first, last) detection times of a species, or (None, None) if it was never seen."""
+    # two single-ended lookups, each a seek on idx_detections_name_date, instead of scanning the species
+    query = '''
+        SELECT (SELECT detection_time FROM {schema}.detections WHERE display_name = ?
+                ORDER BY detection_date, detection_time LIMIT 1),
+               (SELECT detection_time FROM {schema}.detections WHERE display_name = ?
+                ORDER BY detection_date DESC, detection_time DESC LIMIT 1)
+    '''
+    firsts, lasts = [], []
+    with read_connection() as conn:
+        for schema in detection_sources(conn, '0000-01-01', '9999-12-31'):
+            first, last = conn.execute(query.format(schema=schema), (scientific_name, scientific_name)).fetchone()
+            if first is not None:
+                firsts.append(first)
+                lasts.append(last)
+    return min(firsts, default=None), max(lasts, default=None)
+
+
+EXPORT_COLUMNS = ['id', 'detection_time', 'detection_date', 'detection_hour', 'display_name', 'common_name',
+                  'score', 'camera_name', 'frigate_event', 'category_name', 'detection_index']
+
+
+def encode_cursor(detection_time, detection_id):
+    return base64.urlsafe_b64encode(f"{detection_time}|{detection_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns the (detection_time, id) a cursor points at. Raises ValueError for a malformed cursor."""
+    try:
+        detection_time, detection_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return detection_time, int(detection_id)
+    except ValueError as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def _export_filter(start_date, end_date, scientific_name, cursor):
+    # detection_time is 'YYYY-MM-DD HH:MM:SS', so the date range is a range on idx_detections_time and
+    # (detection_time, id) is a key that index can be walked by
+    end = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    where = "detection_time >= ? AND detection_time < ?"
+    params = (start_date, end)
+    if scientific_name is not None:
+        where += " AND display_name = ?"
+        params += (scientific_name,)
+    if cursor is not None:
+        where += " AND (detection_time, id) > (?, ?)"
+        params += decode_cursor(cursor)
+    return where, params
+
+
+def export_page_end(start_date, end_date, scientific_name=None, cursor=None, limit=1000):
+    """Returns the cursor of the last row of a `limit` row page, or None when the page isn't full."""
+    where, params = _export_filter(start_date, end_date, scientific_name, cursor)
+    with QUERY_SECONDS.time(query='export_page_end'):
+        rows = fetch_detections(where, params, start_date, end_date, ('detection_time', 'id'), limit,
+                                columns='detection_time, id')
+    return encode_cursor(*rows[limit - 1]) if len(rows) == limit else None
+
+
+def iter_detections(start_date, end_date, scientific_name=None, cursor=None, limit=None, batch_size=1000):
+    """Yields detections in the range as dicts, oldest first, without holding more than one batch.
+
+    Each batch is a separate keyset query that continues after the last row of the previous one,
+    so no read transaction is held open between batches and memory use doesn't grow with the range.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        where, params = _export_filter(start_date, end_date, scientific_name, cursor)
+        with QUERY_SECONDS.time(query='iter_detections'):
+            rows = fetch_detections(where, params, start_date, end_date, ('detection_time', 'id'), size)
+        for row in rows:
+            record = dict(row)
+            record['common_name'] = get_common_name(record['display_name'])
+            yield record
+        if len(rows) < size:
+            return
+        cursor = encode_cursor(rows[-1]['detection_time'], rows[-1]['id'])
+        if remaining is not None:
+            remaining -= len(rows)
+
+
+@timed(QUERY_SECONDS, query='get_last_change_id')
+def get_last_change_id():
+    return fetchall("SELECT COALESCE(MAX(id), 0) FROM detection_changes")[0][0]
+
+
+def _bucket(conn, detection_date, detection_hour, display_name):
+    count = conn.execute("""
+        SELECT count FROM species_hourly_counts
+        WHERE detection_date = ? AND detection_hour = ? AND display_name = ?
+    """, (detection_date, detection_hour, display_name)).fetchone()
+    total = conn.execute("""
+        SELECT COALESCE(SUM(count), 0) FROM species_hourly_counts
+        WHERE detection_date = ? AND display_name = ?
+    """, (detection_date, display_name)).fetchone()[0]
+    return {
+        'date': detection_date,
+        'hour': detection_hour,
+        'scientific_name': display_name,
+        'common_name': get_common_name(display_name),
+        'count': count[0] if count else 0,
+        'total': total,
+    }
+
+
+@timed(QUERY_SECONDS, query='get_detection_changes')
+def get_detection_changes(since_id, limit=100):
+    """Returns the detection changes logged after `since_id`, oldest first.
+
+    Each change carries the detection as it is now and the current counts of the summary cells
+    it touched, so applying a change sets values rather than incrementing them and replaying one
+    twice is harmless.
+    """
+    with read_connection() as conn:
+        changes = conn.execute("SELECT * FROM detection_changes WHERE id > ? ORDER BY id LIMIT ?",
+                               (since_id, limit)).fetchall()
+        result = []
+        for change in changes:
+            detection = conn.execute("SELECT * FROM detections WHERE frigate_event = ?",
+                                     (change['frigate_event'],)).fetchone()
+            if detection is not None:
+                detection = dict(detection)
+                detection['common_name'] = get_common_name(detection['display_name'])
+
+            new = (change['detection_date'], change['detection_hour'], change['display_name'])
+            old = (change['old_detection_date'], change['old_detection_hour'], change['old_display_name'])
+            buckets = [_bucket(conn, *new)]
+            if old[0] is not None and old != new:
+                buckets.append(_bucket(conn, *old))
+
+            result.append({
+                'id': change['id'],
+                'change_type': change['change_type'],
+                'frigate_event': change['frigate_event'],
+                'detection': detection,
+                'buckets': buckets,
+            })
+        return result
@@ -0,0 +1,364 @@
+import csv
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import generations
+import meta
+import rollups
+from change_log import record_change
+from queries import get_common_name
+from shards import camera_threshold
+from sublabels import queue_sublabel
+
+# Used by `manage.py reclassify` to run the stored detections through a new model or threshold.
+# Snapshots come from a local folder when they are there and from Frigate otherwise, a few at a
+# time and rate limited. Each page of detections is classified across a pool of processes, each
+# with its own interpreter, and written back in one transaction together with its rollup
+# buckets, change log rows, data generations, sublabels and the checkpoint, so an interrupted run resumes after
+# the last page it wrote.
+
+CHECKPOINT = 'reclassify_checkpoint'
+
+BACKGROUND_INDEX = 964
+
+# a page is written in one transaction; a few are fetched ahead so the process pool stays busy
+FETCH_AHEAD_PAGES = 2
+
+_interpreter = None
+_labels = None
+
+
+class RateLimiter:
+    """A token bucket: allows `rate` calls per second on average and bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SnapshotSource:
+    """Returns an event's snapshot from `snapshot_dir` if it's there, or fetches a crop from Frigate."""
+
+    def __init__(self, frigate_url, snapshot_dir=None, rate=5, concurrency=4, timeout=15):
+        self.frigate_url = frigate_url
+        self.snapshot_dir = snapshot_dir
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=concurrency))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=concurrency))
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def _count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def _local(self, camera, frigate_event):
+        # Frigate saves snapshots as <camera>-<event>.jpg in its clips folder
+        for name in (f'{camera}-{frigate_event}.jpg', f'{frigate_event}.jpg'):
+            path = os.path.join(self.snapshot_dir, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return f.read()
+        return None
+
+    def get(self, camera, frigate_event):
+        if self.snapshot_dir:
+            content = self._local(camera, frigate_event)
+            if content is not None:
+                self._count('local')
+                return content
+
+        self.limiter.acquire()
+        try:
+            response = self.session.get(f"{self.frigate_url}/api/events/{frigate_event}/snapshot.jpg",
+                                        params={'crop': 1, 'quality': 95}, timeout=self.timeout)
+        except requests.RequestException:
+            self._count('failed')
+            return None
+        if response.status_code != 200:
+            # events that Frigate has already cleaned up can't be reclassified
+            self._count('missing' if response.status_code == 404 else 'failed')
+            return None
+        self._count('frigate')
+        return response.content
+
+
+def _init_worker(model_path, num_threads, max_batch_size):
+    global _interpreter, _labels
+    from inference import BatchInterpreter, load_labels
+    _interpreter = BatchInterpreter(model_path, num_threads, max_batch_size=max_batch_size)
+    _labels = load_labels(model_path)
+
+
+def _classify_batch(snapshots):
+    """Runs in a pool process. Returns the top (index, score, display_name, category_name) of each snapshot."""
+    import numpy as np
+    from preprocess import letterbox
+
+    images = []
+    for content in snapshots:
+        try:
+            images.append(letterbox(content, out=np.zeros((224, 224, 3), dtype=np.uint8)))
+        except Exception:
+            images.append(None)
+    decoded = [image for image in images if image is not None]
+    scores = iter(_interpreter.run(decoded) if decoded else [])
+
+    display_names, category_names = _labels
+    results = []
+    for image in images:
+        if image is None:
+            results.append(None)
+            continue
+        row = next(scores)
+        index = int(np.argmax(row))
+        results.append((index, float(row[index]), display_names[index], category_names[index]))
+    return results
+
+
+def load_checkpoint(cursor, run_key):
+    value = meta.get_value(cursor, CHECKPOINT)
+    if value is None:
+        return 0
+    checkpoint = json.loads(value)
+    if checkpoint.get('run') != run_key:
+        print("The model or thresholds changed since the last run, starting from the first detection", flush=True)
+        return 0
+    return checkpoint['last_id']
+
+
+def save_checkpoint(cursor, run_key, last_id):
+    meta.set_value(cursor, CHECKPOINT, json.dumps({'run': run_key, 'last_id': last_id}))
+
+
+def run_key(config, model_path):
+    """Identifies what a run classifies with, so a changed model doesn't resume an old run."""
+    return {
+        'model': os.path.abspath(model_path),
+        'model_mtime': os.path.getmtime(model_path),
+        'threshold': config['classification']['threshold'],
+        'camera_settings': config.get('camera_settings') or {},
+    }
+
+
+class Reclassifier:
+    """Reclassifies stored detections. Call run(conn); it returns a Counter of what happened."""
+
+    def __init__(self, config, model_path, source, processes=None, threads_per_process=1, page_size=64,
+                 dry_run=False, delete_rejected=False, report_path=None, progress_interval=10):
+        self.config = config
+        self.model_path = model_path
+        self.source = source
+        self.processes = processes or os.cpu_count() or 1
+        self.threads_per_process = threads_per_process
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.delete_rejected = delete_rejected
+        self.report_path = report_path
+        self.progress_interval = progress_interval
+        self.sublabels = config.get('sublabels', {}).get('enabled', True)
+        self.outcomes = Counter()
+        self.transitions = Counter()
+        self.report = None
+
+    def pages(self, conn, after_id, limit=None):
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = self.page_size if remaining is None else min(self.page_size, remaining)
+            rows = conn.execute("""
+                SELECT id, frigate_event, camera_name, detection_time, detection_index, score, display_name
+                FROM detections WHERE id > ? ORDER BY id LIMIT ?
+            """, (after_id, size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            after_id = rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def run(self, conn, restart=False, limit=None):
+        key = run_key(self.config, self.model_path)
+        start_id = 0 if restart or self.dry_run else load_checkpoint(conn, key)
+        total = conn.execute("SELECT COUNT(*) FROM detections WHERE id > ?", (start_id,)).fetchone()[0]
+        if limit is not None:
+            total = min(total, limit)
+        if start_id:
+            print(f"Resuming after detection {start_id}", flush=True)
+        print(f"Reclassifying {total} detections with {self.model_path} on {self.processes} processes"
+              f"{' (dry run)' if self.dry_run else ''}", flush=True)
+
+        report_file = open(self.report_path, 'w', newline='') if self.report_path else None
+        if report_file is not None:
+            self.report = csv.writer(report_file)
+            self.report.writerow(['frigate_event', 'camera_name', 'detection_time', 'action', 'old_display_name',
+                                  'old_score', 'new_display_name', 'new_score'])
+
+        # spawn, so the pool processes don't inherit the fetch threads
+        classify_pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker,
+                                            initargs=(self.model_path, self.threads_per_process,
+                                                      -(-self.page_size // self.processes)))
+        fetch_pool = ThreadPoolExecutor(self.source.concurrency)
+        started = time.monotonic()
+        last_progress = started
+        done = 0
+        fetching = deque()
+        classifying = deque()
+        try:
+            for rows in self.pages(conn, start_id, limit):
+                fetching.append((rows, [fetch_pool.submit(self.source.get, row[2], row[1]) for row in rows]))
+                if len(fetching) > FETCH_AHEAD_PAGES:
+                    classifying.append(self._classify(classify_pool, *fetching.popleft()))
+                if len(classifying) > 1:
+                    done += self._write(conn, key, *classifying.popleft())
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    self._print_progress(done, total, started)
+            while fetching:
+                classifying.append(self._classify(classify_pool, *fetching.popleft()))
+            while classifying:
+                done += self._write(conn, key, *classifying.popleft())
+        finally:
+            # shutdown(cancel_futures=True) needs Python 3.9, and the image runs 3.8: cancel what is
+            # still queued by hand. Both deques are empty unless the run is being interrupted.
+            fetch_pool.shutdown(wait=False)
+            classify_pool.shutdown(wait=False)
+            for _, fetches in fetching:
+                for future in fetches:
+                    future.cancel()
+            for _, jobs in classifying:
+                for _, job in jobs:
+                    job.cancel()
+            if report_file is not None:
+                report_file.close()
+
+        if self.outcomes['deleted']:
+            meta.refresh_earliest_detection_date(conn)
+            conn.commit()
+        self._print_progress(done, total, started)
+        return self.outcomes
+
+    def _classify(self, pool, rows, fetches):
+        snapshots = [future.result() for future in fetches]
+        fetched = [(row, content) for row, content in zip(rows, snapshots) if content is not None]
+        self.outcomes['not_fetched'] += len(rows) - len(fetched)
+        chunk = max(1, -(-len(fetched) // self.processes))
+        jobs = [(fetched[i:i + chunk], pool.submit(_classify_batch, [content for _, content in fetched[i:i + chunk]]))
+                for i in range(0, len(fetched), chunk)]
+        return rows, jobs
+
+    def _write(self, conn, key, rows, jobs):
+        results = [(row, result) for batch, job in jobs for (row, _), result in zip(batch, job.result())]
+        if self.dry_run:
+            for row, result in results:
+                self._apply(None, row, result)
+            return len(rows)
+
+        # the checkpoint is saved with the page's changes, so a page is either fully written or redone
+        isolation_level = conn.isolation_level
+        conn.isolation_level = None
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for row, result in results:
+                    self._apply(cursor, row, result)
+                save_checkpoint(cursor, key, rows[-1][0])
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+        finally:
+            conn.isolation_level = isolation_level
+        return len(rows)
+
+    def _apply(self, cursor, row, result):
+        detection_id, frigate_event, camera, detection_time, old_index, old_score, old_name = row
+        if result is None:
+            self.outcomes['undecodable'] += 1
+            return
+        index, score, display_name, category_name = result
+
+        if index == BACKGROUND_INDEX or score <= camera_threshold(self.config, camera):
+            action = 'deleted' if self.delete_rejected else 'rejected'
+        elif index != old_index:
+            action = 'changed'
+        elif score != old_score:
+            action = 'rescored'
+        else:
+            action = 'unchanged'
+        self.outcomes[action] += 1
+        if action in ('changed', 'deleted', 'rejected'):
+            new_name = display_name if action == 'changed' else None
+            self.transitions[(old_name, new_name)] += 1
+        if self.report is not None and action != 'unchanged':
+            self.report.writerow([frigate_event, camera, detection_time, action, old_name, f'{old_score:.3f}',
+                                  display_name, f'{score:.3f}'])
+        if cursor is None or action in ('unchanged', 'rejected'):
+            return
+
+        # read the row again inside the transaction: ingest may have updated it since the page was read
+        stored = cursor.execute("SELECT detection_date, detection_hour, display_name FROM detections WHERE id = ?",
+                                (detection_id,)).fetchone()
+        if stored is None:
+            return
+        if action == 'deleted':
+            cursor.execute("DELETE FROM detections WHERE id = ?", (detection_id,))
+            rollups.remove_detection(cursor, *stored)
+            record_change(cursor, frigate_event, 'deleted', stored, stored)
+            generations.bump(cursor, stored[0])
+            return
+
+        cursor.execute("""
+            UPDATE detections SET detection_index = ?, score = ?, display_name = ?, category_name = ?
+            WHERE id = ?
+        """, (index, score, display_name, category_name, detection_id))
+        new = (stored[0], stored[1], display_name)
+        rollups.move_detection(cursor, stored, new)
+        record_change(cursor, frigate_event, 'updated', new, stored)
+        generations.bump(cursor, stored[0])
+        if self.sublabels and display_name != stored[2]:
+            queue_sublabel(cursor, frigate_event, get_common_name(display_name))
+
+    def _print_progress(self, done, total, started):
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0.0
+        eta = (total - done) / rate if rate else 0.0
+        sources = ', '.join(f"{key} {value}" for key, value in sorted(self.source.counts.items()))
+        print(f"Reclassified {done}/{total} detections, {rate:.1f}/s, ETA {eta / 60:.1f} min; "
+              f"snapshots: {sources or 'none yet'}", flush=True)
+
+    def format_summary(self, top=20):
+        lines = [', '.join(f"{key} {value}" for key, value in sorted(self.outcomes.items())) or "nothing to do"]
+        for (old_name, new_name), count in self.transitions.most_common(top):
+            new = get_common_name(new_name) if new_name is not None else "(below threshold)"
+            lines.append(f"  {count:>6}  {get_common_name(old_name)} -> {new}")
+        return '\n'.join(lines)
@@ -0,0 +1,219 @@
+import glob
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+import generations
+import meta
+
+# Detections older than the hot window are moved out of speciesid.db into one archive database
+# per year, ./data/archive/speciesid-<year>.db, so the main database stops growing. Whole days
+# are moved at a time and species_hourly_counts keeps their counts, so the summaries and the
+# date picker still cover archived days. Queries over raw detections attach the archives they
+# need, read-only, one at a time.
+
+ARCHIVE_DIR = './data/archive'
+
+ARCHIVE_COLUMNS = ('id', 'detection_time', 'detection_index', 'score', 'display_name', 'category_name',
+                   'frigate_event', 'camera_name', 'detection_date', 'detection_hour')
+
+
+def archive_path(year):
+    return os.path.join(ARCHIVE_DIR, f'speciesid-{year}.db')
+
+
+def create_archive_tables(conn, schema):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.detections (
+            id INTEGER PRIMARY KEY,
+            detection_time TIMESTAMP NOT NULL,
+            detection_index INTEGER NOT NULL,
+            score REAL NOT NULL,
+            display_name TEXT NOT NULL,
+            category_name TEXT NOT NULL,
+            frigate_event TEXT NOT NULL,
+            camera_name TEXT NOT NULL,
+            detection_date TEXT NOT NULL,
+            detection_hour INTEGER NOT NULL
+        )
+    """)
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS {schema}.idx_detections_date_name
+        ON detections (detection_date, display_name, detection_hour)
+    """)
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS {schema}.idx_detections_name_date
+        ON detections (display_name, detection_date)
+    """)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_detections_time ON detections (detection_time)")
+
+
+def archive_years():
+    years = []
+    for path in glob.glob(os.path.join(ARCHIVE_DIR, 'speciesid-*.db')):
+        year = os.path.basename(path)[len('speciesid-'):-len('.db')]
+        if year.isdigit():
+            years.append(int(year))
+    return sorted(years)
+
+
+def detection_sources(conn, start_date, end_date):
+    """Yields the schemas holding detections between the dates: 'main', then the archives.
+
+    Each archive is attached read-only just while the caller uses it, so any number of years
+    can be covered without running into SQLite's limit on attached databases.
+    """
+    yield 'main'
+    archived_before = meta.get_value(conn, meta.ARCHIVED_BEFORE)
+    if archived_before is None or start_date >= archived_before:
+        return
+    last_year = int(min(end_date, archived_before)[:4])
+    for year in archive_years():
+        if not int(start_date[:4]) <= year <= last_year:
+            continue
+        schema = f'archive_{year}'
+        conn.execute(f"ATTACH DATABASE ? AS {schema}", (f'file:{os.path.abspath(archive_path(year))}?mode=ro',))
+        try:
+            yield schema
+        finally:
+            conn.execute(f"DETACH DATABASE {schema}")
+
+
+def archive(conn, hot_days, batch_size=500):
+    """Moves detections from before the hot window into the yearly archives. Returns how many moved.
+
+    Each batch is copied and committed to the archive before it is deleted from the main
+    database, so an interruption leaves rows in both places at worst, and the next run skips
+    the copies it already made. archived_before is moved past a year before its rows are, so
+    queries running meanwhile already look in its archive for the rows that have left main.
+    """
+    cutoff = (datetime.now() - timedelta(days=hot_days)).strftime('%Y-%m-%d')
+    first_date = conn.execute("SELECT MIN(detection_date) FROM detections").fetchone()[0]
+    if first_date is None or first_date >= cutoff:
+        return 0
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    moved = 0
+    columns = ', '.join(ARCHIVE_COLUMNS)
+    try:
+        for year in range(int(first_date[:4]), int(cutoff[:4]) + 1):
+            year_end = min(f'{year + 1}-01-01', cutoff)
+            if conn.execute("SELECT 1 FROM main.detections WHERE detection_date >= ? AND detection_date < ? LIMIT 1",
+                            (f'{year}-01-01', year_end)).fetchone() is None:
+                continue
+            conn.execute("ATTACH DATABASE ? AS archive", (archive_path(year),))
+            try:
+                create_archive_tables(conn, 'archive')
+                # rollups.rebuild and check leave days before this alone from now on
+                if year_end > meta.get_value(conn, meta.ARCHIVED_BEFORE, ''):
+                    meta.set_value(conn, meta.ARCHIVED_BEFORE, year_end)
+                while True:
+                    ids = [row[0] for row in conn.execute("""
+                        SELECT id FROM main.detections
+                        WHERE detection_date >= ? AND detection_date < ?
+                        LIMIT ?
+                    """, (f'{year}-01-01', year_end, batch_size))]
+                    if not ids:
+                        break
+                    placeholders = ', '.join('?' * len(ids))
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO archive.detections ({columns})
+                        SELECT {columns} FROM main.detections WHERE id IN ({placeholders})
+                    """, ids)
+                    conn.execute("COMMIT")
+                    conn.execute("BEGIN IMMEDIATE")
+                    # pages cached while the rows were in both databases may have counted them twice
+                    generations.bump(conn, *[row[0] for row in conn.execute(
+                        f"SELECT DISTINCT detection_date FROM main.detections WHERE id IN ({placeholders})", ids)])
+                    conn.execute(f"DELETE FROM main.detections WHERE id IN ({placeholders})", ids)
+                    conn.execute("COMMIT")
+                    moved += len(ids)
+            finally:
+                conn.execute("DETACH DATABASE archive")
+
+        if cutoff > meta.get_value(conn, meta.ARCHIVED_BEFORE, ''):
+            meta.set_value(conn, meta.ARCHIVED_BEFORE, cutoff)
+    finally:
+        conn.isolation_level = isolation_level
+    return moved
+
+
+def maintain(conn, vacuum_pages=1000):
+    """Returns free pages to the filesystem a few at a time and refreshes the query planner statistics."""
+    freed = 0
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        # incremental: each step holds the write lock briefly, so ingest isn't stalled
+        while conn.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            before = conn.execute("PRAGMA page_count").fetchone()[0]
+            # executescript steps the pragma to completion; execute() would free a single page
+            conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+            step = before - conn.execute("PRAGMA page_count").fetchone()[0]
+            if step <= 0:
+                break
+            freed += step
+            time.sleep(0.1)
+    conn.execute("PRAGMA optimize")
+    # PASSIVE never waits on readers or the writer; the WAL file is reused rather than shrunk
+    conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return freed
+
+
+def compact(conn):
+    """Rewrites the whole database with incremental auto-vacuum enabled. Blocks writers while it runs."""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute("ANALYZE")
+    finally:
+        conn.isolation_level = isolation_level
+
+
+class RetentionJob:
+    """Archives old detections and maintains the database in the background, every `interval` hours."""
+
+    def __init__(self, hot_days=0, interval_hours=24, batch_size=500, vacuum_pages=1000):
+        self.hot_days = hot_days
+        self.interval = interval_hours * 3600
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+
+    def start(self):
+        threading.Thread(target=self._run, name="retention", daemon=True).start()
+
+    def run_once(self, conn):
+        start = time.monotonic()
+        moved = archive(conn, self.hot_days, self.batch_size) if self.hot_days else 0
+        freed = maintain(conn, self.vacuum_pages)
+        print(f"Database maintenance: archived {moved} detections, freed {freed} pages "
+              f"in {time.monotonic() - start:.1f} s", flush=True)
+
+    def _run(self):
+        # let startup finish first
+        time.sleep(60)
+        conn = db.connect()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("The database was created without incremental auto-vacuum, so maintenance can't return free "
+                  "space to the filesystem. Run 'python manage.py compact --full' once to enable it.", flush=True)
+        while True:
+            try:
+                self.run_once(conn)
+            except Exception as e:
+                print(f"Database maintenance failed: {e}", flush=True)
+            time.sleep(self.interval)
+
+
+def build_retention_job(retention_config):
+    retention_config = retention_config or {}
+    if not retention_config.get('enabled', True):
+        return None
+    return RetentionJob(hot_days=retention_config.get('hot_days', 0),
+                        interval_hours=retention_config.get('interval_hours', 24),
+                        batch_size=retention_config.get('batch_size', 500),
+                        vacuum_pages=retention_config.get('vacuum_pages', 1000))
@@ -0,0 +1,85 @@
+# species_hourly_counts holds the number of detections per (date, hour, species) so the daily
+# summary doesn't have to group a whole day of detections on every page load. It is kept up to
+# date in the same transaction as every write to detections; rebuild() recomputes it from scratch.
+
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS species_hourly_counts (
+            detection_date TEXT NOT NULL,
+            detection_hour INTEGER NOT NULL,
+            display_name TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (detection_date, detection_hour, display_name)
+        ) WITHOUT ROWID
+    """)
+
+
+def add_detection(cursor, detection_date, detection_hour, display_name, amount=1):
+    cursor.execute("""
+        INSERT INTO species_hourly_counts (detection_date, detection_hour, display_name, count)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (detection_date, detection_hour, display_name) DO UPDATE SET count = count + excluded.count
+    """, (detection_date, detection_hour, display_name, amount))
+    if amount < 0:
+        cursor.execute("""
+            DELETE FROM species_hourly_counts
+            WHERE detection_date = ? AND detection_hour = ? AND display_name = ? AND count <= 0
+        """, (detection_date, detection_hour, display_name))
+
+
+def remove_detection(cursor, detection_date, detection_hour, display_name):
+    add_detection(cursor, detection_date, detection_hour, display_name, amount=-1)
+
+
+def move_detection(cursor, old, new):
+    """Moves one detection between buckets, e.g. when a higher score changes an event's species.
+
+    old and new are (detection_date, detection_hour, display_name) tuples.
+    """
+    if tuple(old) == tuple(new):
+        return
+    remove_detection(cursor, *old)
+    add_detection(cursor, *new)
+
+
+def rebuild(cursor, since=None):
+    """Recomputes the rollup from detections, from the date `since` on if given.
+
+    Days before `since` are left alone; their detections have been moved to the archives.
+    """
+    since = since or ''
+    cursor.execute("DELETE FROM species_hourly_counts WHERE detection_date >= ?", (since,))
+    cursor.execute("""
+        INSERT INTO species_hourly_counts (detection_date, detection_hour, display_name, count)
+        SELECT detection_date, detection_hour, display_name, COUNT(*)
+        FROM detections
+        WHERE detection_date >= ?
+        GROUP BY detection_date, detection_hour, display_name
+    """, (since,))
+
+
+def check(cursor, since=None):
+    """Compares the rollup with the raw detections, from the date `since` on if given.
+
+    Returns a list of (detection_date, detection_hour, display_name, rollup_count, actual_count)
+    for every bucket that doesn't match. An empty list means the rollup is consistent.
+    """
+    since = since or ''
+    cursor.execute("""
+        SELECT detection_date, detection_hour, display_name, SUM(rollup_count), SUM(actual_count)
+        FROM (
+            SELECT detection_date, detection_hour, display_name, count AS rollup_count, 0 AS actual_count
+            FROM species_hourly_counts
+            WHERE detection_date >= ?
+            UNION ALL
+            SELECT detection_date, detection_hour, display_name, 0, COUNT(*)
+            FROM detections
+            WHERE detection_date >= ?
+            GROUP BY detection_date, detection_hour, display_name
+        )
+        GROUP BY detection_date, detection_hour, display_name
+        HAVING SUM(rollup_count) != SUM(actual_count)
+        ORDER BY detection_date, detection_hour, display_name
+    """, (since, since))
+    return cursor.fetchall()
@@ -0,0 +1,292 @@
+import copy
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import yaml
+
+# With sharding enabled, the MQTT process only receives and deduplicates events. Each camera's
+# events are classified and stored by a shard: a separate process with its own interpreter,
+# model and threads, so cameras run on their own cores instead of sharing one GIL. A shard's
+# settings are the global config with that camera's `camera_settings` entry merged over it.
+# The supervisor restarts shards that die and starts, stops or resizes them when config.yml
+# changes which cameras are watched.
+
+CONFIG_PATH = './config/config.yml'
+
+
+def merge(base, overrides):
+    """Returns a copy of `base` with the nested sections of `overrides` merged over it."""
+    merged = copy.deepcopy(base)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def camera_overrides(config, camera):
+    return (config.get('camera_settings') or {}).get(camera) or {}
+
+
+def camera_threshold(config, camera):
+    overrides = camera_overrides(config, camera).get('classification') or {}
+    return overrides.get('threshold', config['classification']['threshold'])
+
+
+def shard_configs(config, cpu_count=None):
+    """Returns {camera: config} for every watched camera.
+
+    Cameras without their own num_threads split the host's cores evenly, so adding a camera
+    shrinks the thread budget of the others rather than oversubscribing the CPU.
+    """
+    cameras = config['frigate']['camera']
+    budget = max(1, (cpu_count or os.cpu_count() or 1) // max(1, len(cameras)))
+    configs = {}
+    for camera in cameras:
+        overrides = camera_overrides(config, camera)
+        shard_config = merge(config, overrides)
+        shard_config['frigate']['camera'] = [camera]
+        if 'num_threads' not in (overrides.get('classification') or {}):
+            classification = shard_config['classification']
+            classification['num_threads'] = min(classification.get('num_threads', 1), budget)
+        configs[camera] = shard_config
+    return configs
+
+
+class Shard:
+
+    def __init__(self, camera, config):
+        self.camera = camera
+        self.config = config
+        self.process = None
+        self.events = None
+        self.in_flight = None
+        self.started = 0
+        self.restarts = 0
+        self.crashes = 0
+        self.dropped = 0
+        self.next_start = 0
+
+
+class ShardSupervisor:
+    """Runs one shard process per camera and routes each event to its camera's shard.
+
+    `target(camera, config, events, notifications, in_flight)` is the shard's entry point. It
+    reads (received, after_data, caught_up) tuples from `events` until it gets None, and may put
+    messages on `notifications`, which are handed to `on_notification` in this process. The
+    supervisor adds one to the shared `in_flight` counter for every event it queues, and the
+    shard takes one off when it is finished with the event, so `idle()` also sees the events a
+    shard is still fetching, classifying or storing.
+    """
+
+    def __init__(self, config, target, on_notification=None, config_path=CONFIG_PATH, queue_size=100,
+                 check_interval=5, max_restart_delay=60):
+        self.config = config
+        self.target = target
+        self.on_notification = on_notification
+        self.config_path = config_path
+        self.queue_size = queue_size
+        self.check_interval = check_interval
+        self.max_restart_delay = max_restart_delay
+        # spawn, not fork: this process already runs MQTT, writer and dispatcher threads
+        self.context = multiprocessing.get_context('spawn')
+        self.notifications = self.context.Queue()
+        self.shards = {}
+        self.lock = threading.Lock()
+        self.config_mtime = self._config_mtime()
+
+    @property
+    def cameras(self):
+        return self.shards.keys()
+
+    def start(self):
+        self._apply(shard_configs(self.config))
+        threading.Thread(target=self._monitor, name="shard-supervisor", daemon=True).start()
+        threading.Thread(target=self._read_notifications, name="shard-notifications", daemon=True).start()
+
+    def dispatch(self, after_data, caught_up=False):
+        """Queues an event for its camera's shard. Returns False when the shard's queue is full.
+
+        Missed events found by catch-up are marked `caught_up`, so the shard waits for room
+        for them instead of discarding live events it has queued.
+        """
+        with self.lock:
+            shard = self.shards.get(after_data['camera'])
+            if shard is None or shard.events is None:
+                return False
+            try:
+                shard.events.put_nowait((time.monotonic(), after_data, caught_up))
+            except queue.Full:
+                if not caught_up:
+                    shard.dropped += 1
+                return False
+            with shard.in_flight.get_lock():
+                shard.in_flight.value += 1
+            return True
+
+    def dispatch_missed(self, after_data):
+        return self.dispatch(after_data, caught_up=True)
+
+    def idle(self):
+        with self.lock:
+            return all(shard.in_flight.value <= 0 for shard in self.shards.values() if shard.in_flight is not None)
+
+    def stop(self):
+        with self.lock:
+            stopping = list(self.shards.values())
+            self.shards = {}
+        for shard in stopping:
+            self._stop_shard(shard)
+
+    def _start_shard(self, shard):
+        # a fresh queue and counter each time: those of a crashed shard may be unusable or stuck
+        shard.events = self.context.Queue(self.queue_size)
+        shard.in_flight = self.context.Value('i', 0)
+        shard.process = self.context.Process(target=self.target, name=f"shard-{shard.camera}", daemon=True,
+                                             args=(shard.camera, shard.config, shard.events, self.notifications,
+                                                   shard.in_flight))
+        shard.process.start()
+        shard.started = time.monotonic()
+        print(f"Started shard for camera {shard.camera} (pid {shard.process.pid}, "
+              f"{shard.config['classification']['num_threads']} inference threads)", flush=True)
+
+    def _stop_shard(self, shard, timeout=10):
+        if shard.process is None:
+            return
+        try:
+            shard.events.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        shard.process.join(timeout)
+        if shard.process.is_alive():
+            shard.process.terminate()
+            shard.process.join()
+        print(f"Stopped shard for camera {shard.camera}", flush=True)
+
+    def _apply(self, configs):
+        """Starts shards for new cameras, stops removed ones and restarts those whose settings changed.
+
+        Only reading the routing table and swapping in the new one happen under the lock. New
+        shards are spawned, and old ones drained and joined, outside it: both can take a while,
+        and dispatch() must not wait for them on the MQTT thread. Until the swap, events for a
+        camera whose settings changed still go to its old shard.
+        """
+        with self.lock:
+            current = dict(self.shards)
+        starting = [Shard(camera, shard_config) for camera, shard_config in configs.items()
+                    if camera not in current or current[camera].config != shard_config]
+        for shard in starting:
+            self._start_shard(shard)
+
+        with self.lock:
+            shards = {camera: shard for camera, shard in self.shards.items() if camera in configs}
+            shards.update((shard.camera, shard) for shard in starting)
+            stopping = [shard for shard in self.shards.values() if shards.get(shard.camera) is not shard]
+            self.shards = shards
+        for shard in stopping:
+            self._stop_shard(shard)
+
+    def _config_mtime(self):
+        try:
+            return os.path.getmtime(self.config_path)
+        except OSError:
+            return None
+
+    def _reload_config(self):
+        mtime = self._config_mtime()
+        if mtime == self.config_mtime:
+            return
+        self.config_mtime = mtime
+        try:
+            with open(self.config_path) as f:
+                config = yaml.safe_load(f)
+            configs = shard_configs(config)
+        except Exception as e:
+            print(f"Not applying changed config: {e}", flush=True)
+            return
+        print("Config changed, rebalancing shards", flush=True)
+        self.config = config
+        self._apply(configs)
+
+    def _restart_dead_shards(self):
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for shard in self.shards.values():
+                if shard.process.is_alive():
+                    continue
+                if shard.next_start == 0:
+                    # back off while a shard keeps crashing soon after starting
+                    shard.crashes = shard.crashes + 1 if now - shard.started < 5 * 60 else 1
+                    delay = min(self.max_restart_delay, 2 ** (shard.crashes - 1))
+                    shard.next_start = now + delay
+                    print(f"Shard for camera {shard.camera} exited with code {shard.process.exitcode}, "
+                          f"restarting in {delay} s", flush=True)
+                if now >= shard.next_start:
+                    due.append(shard)
+
+        # spawned outside the lock like in _apply, then swapped in for the dead shard
+        for dead in due:
+            shard = Shard(dead.camera, dead.config)
+            shard.restarts = dead.restarts + 1
+            shard.crashes = dead.crashes
+            shard.dropped = dead.dropped
+            self._start_shard(shard)
+            with self.lock:
+                replaced = self.shards.get(dead.camera) is dead
+                if replaced:
+                    self.shards[dead.camera] = shard
+            if not replaced:
+                # the camera was removed in the meantime
+                self._stop_shard(shard)
+
+    def _monitor(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self._reload_config()
+                self._restart_dead_shards()
+            except Exception as e:
+                print(f"Shard supervisor failed: {e}", flush=True)
+
+    def _read_notifications(self):
+        while True:
+            message = self.notifications.get()
+            if self.on_notification is not None:
+                self.on_notification(message)
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for camera, shard in self.shards.items():
+                try:
+                    queue_length = shard.events.qsize()
+                except NotImplementedError:
+                    queue_length = 0
+                result[camera] = {
+                    'alive': int(shard.process.is_alive()),
+                    'in_flight': shard.in_flight.value,
+                    'restarts': shard.restarts,
+                    'dropped': shard.dropped,
+                    'queue_length': queue_length,
+                    'num_threads': shard.config['classification']['num_threads'],
+                }
+            return result
+
+    def format_stats(self):
+        return ", ".join(f"{camera}: {'up' if s['alive'] else 'down'}, queue {s['queue_length']}, "
+                         f"in flight {s['in_flight']}, dropped {s['dropped']}, restarts {s['restarts']}"
+                         for camera, s in self.stats().items())
+
+
+def build_supervisor(config, target, on_notification=None):
+    ingest_config = config.get('ingest') or {}
+    if not ingest_config.get('sharding', False):
+        return None
+    return ShardSupervisor(config, target, on_notification=on_notification,
+                           queue_size=ingest_config.get('shard_queue_size', 100),
+                           check_interval=ingest_config.get('check_interval', 5))
@@ -0,0 +1,188 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import db
+from profiling import INGEST_STAGE_SECONDS
+
+# frigate limits sublabels to 20 characters currently
+MAX_SUBLABEL_LENGTH = 20
+
+# how long sent and failed entries are kept around to deduplicate late updates for the same event
+OUTBOX_RETENTION = 24 * 3600
+
+
+def create_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sublabel_outbox (
+            frigate_event TEXT PRIMARY KEY,
+            sublabel TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL DEFAULT 0,
+            sent_sublabel TEXT,
+            updated_at REAL NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sublabel_outbox_pending
+        ON sublabel_outbox (status, next_attempt)
+    """)
+
+
+def queue_sublabel(cursor, frigate_event, sublabel):
+    """Records the sublabel an event should have. The latest label for an event wins.
+
+    Nothing is sent when the label is the one Frigate already has or the one already waiting
+    to be sent. Returns True when the outbox changed.
+    """
+    sublabel = sublabel[:MAX_SUBLABEL_LENGTH]
+    cursor.execute("""
+        INSERT INTO sublabel_outbox (frigate_event, sublabel, status, attempts, next_attempt, updated_at)
+        VALUES (?, ?, 'pending', 0, 0, ?)
+        ON CONFLICT (frigate_event) DO UPDATE
+        SET sublabel = excluded.sublabel,
+            status = CASE WHEN excluded.sublabel IS sublabel_outbox.sent_sublabel THEN 'sent' ELSE 'pending' END,
+            attempts = 0, next_attempt = 0, updated_at = excluded.updated_at
+        WHERE excluded.sublabel IS NOT sublabel_outbox.sublabel OR sublabel_outbox.status = 'failed'
+    """, (frigate_event, sublabel, time.time()))
+    return cursor.rowcount > 0
+
+
+def _mark_sent(cursor, frigate_event, sublabel):
+    # if a newer label arrived while this one was in flight, the row stays pending for it
+    cursor.execute("""
+        UPDATE sublabel_outbox
+        SET status = CASE WHEN sublabel = ? THEN 'sent' ELSE status END,
+            sent_sublabel = ?, updated_at = ?
+        WHERE frigate_event = ?
+    """, (sublabel, sublabel, time.time(), frigate_event))
+
+
+def _mark_failed(cursor, frigate_event, sublabel, attempts, next_attempt, permanent):
+    cursor.execute("""
+        UPDATE sublabel_outbox
+        SET status = ?, attempts = ?, next_attempt = ?, updated_at = ?
+        WHERE frigate_event = ? AND sublabel = ?
+    """, ('failed' if permanent else 'pending', attempts, next_attempt, time.time(), frigate_event, sublabel))
+
+
+def _prune(cursor, before):
+    cursor.execute("DELETE FROM sublabel_outbox WHERE status != 'pending' AND updated_at < ?", (before,))
+
+
+class SublabelDispatcher:
+    """Sends queued sublabels to Frigate from a background thread.
+
+    The outbox lives in the database, so labels that couldn't be sent survive a restart.
+    Failed POSTs are retried with exponential backoff until `max_attempts` is reached; client
+    errors other than timeouts and rate limiting are not retried.
+    """
+
+    def __init__(self, frigate_url, writer, max_attempts=5, retry_delay=5, max_retry_delay=300, timeout=10):
+        self.frigate_url = frigate_url
+        self.writer = writer
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=2))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=2))
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.counters = {'sent': 0, 'retried': 0, 'failed': 0}
+        self.pending = 0
+        self.last_prune = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name="sublabels", daemon=True).start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def _run(self):
+        conn = db.connect()
+        while True:
+            self.wakeup.clear()
+            try:
+                wait = self._dispatch(conn)
+            except Exception as e:
+                print(f"Sublabel dispatcher error: {e}", flush=True)
+                wait = 60
+            self.wakeup.wait(wait)
+
+    def _dispatch(self, conn):
+        """Sends every sublabel that is due. Returns how long to wait before looking again."""
+        now = time.time()
+        if now - self.last_prune > 3600:
+            self.writer.execute(_prune, now - OUTBOX_RETENTION)
+            self.last_prune = now
+
+        while True:
+            rows = conn.execute("""
+                SELECT frigate_event, sublabel, attempts FROM sublabel_outbox
+                WHERE status = 'pending' AND next_attempt <= ?
+                ORDER BY next_attempt LIMIT 50
+            """, (time.time(),)).fetchall()
+            conn.commit()
+            for frigate_event, sublabel, attempts in rows:
+                self._send(frigate_event, sublabel, attempts)
+            if len(rows) < 50:
+                break
+
+        self.pending, next_attempt = conn.execute("""
+            SELECT COUNT(*), MIN(next_attempt) FROM sublabel_outbox WHERE status = 'pending'
+        """).fetchone()
+        conn.commit()
+        if next_attempt is None:
+            return 60
+        return min(60, max(0.0, next_attempt - time.time()))
+
+    def _send(self, frigate_event, sublabel, attempts):
+        post_url = self.frigate_url + "/api/events/" + frigate_event + "/sub_label"
+        try:
+            with INGEST_STAGE_SECONDS.time(stage='sublabel'):
+                response = self.session.post(post_url, json={"subLabel": sublabel}, timeout=self.timeout)
+            status_code = response.status_code
+        except requests.RequestException as e:
+            print(f"Failed to set sublabel for {frigate_event}: {e}", flush=True)
+            status_code = None
+
+        if status_code == 200:
+            print("Sublabel set successfully to: " + sublabel, flush=True)
+            self.writer.execute(_mark_sent, frigate_event, sublabel)
+            with self.lock:
+                self.counters['sent'] += 1
+            return
+
+        attempts += 1
+        retryable = status_code is None or status_code >= 500 or status_code in (408, 429)
+        permanent = not retryable or attempts >= self.max_attempts
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+        print(f"Failed to set sublabel for {frigate_event}. Status code: {status_code}. "
+              + ("Giving up." if permanent else f"Retrying in {delay} seconds."), flush=True)
+        self.writer.execute(_mark_failed, frigate_event, sublabel, attempts, time.time() + delay, permanent)
+        with self.lock:
+            self.counters['failed' if permanent else 'retried'] += 1
+
+    def stats(self):
+        with self.lock:
+            result = dict(self.counters)
+        result['pending'] = self.pending
+        return result
+
+    def format_stats(self):
+        s = self.stats()
+        return f"sublabels: pending {s['pending']}, sent {s['sent']}, retried {s['retried']}, failed {s['failed']}"
+
+
+def build_dispatcher(config, writer):
+    sublabel_config = config.get('sublabels', {})
+    return SublabelDispatcher(config['frigate']['frigate_url'], writer,
+                              max_attempts=sublabel_config.get('max_attempts', 5),
+                              retry_delay=sublabel_config.get('retry_delay', 5),
+                              max_retry_delay=sublabel_config.get('max_retry_delay', 300),
+                              timeout=sublabel_config.get('timeout', 10))
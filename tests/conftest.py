@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import db  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # the modules find model.tflite, birdnames.db and config/ relative to the working directory
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / 'speciesid.db'))
+    migrate(conn)
+    yield conn
+    conn.close()
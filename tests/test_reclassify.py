@@ -0,0 +1,38 @@
+import cv2
+import numpy as np
+
+import rollups
+import reclassify
+
+CONFIG = {'classification': {'threshold': 0.7}, 'sublabels': {'enabled': False}}
+
+
+def add_detection(conn, frigate_event, detection_index=0, score=0.9, display_name='Cyanocitta cristata'):
+    conn.execute("""
+        INSERT INTO detections (detection_time, detection_index, score, display_name, category_name, frigate_event,
+        camera_name, detection_date, detection_hour)
+        VALUES ('2024-05-01 08:00:00', ?, ?, ?, ?, ?, 'birdcam', '2024-05-01', 8)
+    """, (detection_index, score, display_name, display_name, frigate_event))
+    rollups.add_detection(conn, '2024-05-01', 8, display_name)
+    conn.commit()
+
+
+def test_run_completes_and_checkpoints(conn, tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        add_detection(conn, f'event-{i}')
+        image = rng.integers(0, 256, (300, 300, 3), dtype=np.uint8)
+        cv2.imwrite(str(tmp_path / f'birdcam-event-{i}.jpg'), image)
+    # no snapshot on disk and nothing listening at frigate_url: counted as not fetched
+    add_detection(conn, 'event-missing')
+
+    source = reclassify.SnapshotSource('http://127.0.0.1:9', snapshot_dir=str(tmp_path), rate=0, concurrency=2,
+                                       timeout=1)
+    reclassifier = reclassify.Reclassifier(CONFIG, 'model.tflite', source, processes=1, page_size=2)
+    outcomes = reclassifier.run(conn)
+
+    assert sum(outcomes.values()) == 6
+    assert outcomes['not_fetched'] == 1
+    last_id = conn.execute("SELECT MAX(id) FROM detections").fetchone()[0]
+    assert reclassify.load_checkpoint(conn, reclassify.run_key(CONFIG, 'model.tflite')) == last_id
+    assert rollups.check(conn.cursor()) == []
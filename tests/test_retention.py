@@ -0,0 +1,46 @@
+import db
+import generations
+import retention
+
+
+def add_detection(conn, frigate_event, detection_date):
+    conn.execute("""
+        INSERT INTO detections (detection_time, detection_index, score, display_name, category_name, frigate_event,
+        camera_name, detection_date, detection_hour)
+        VALUES (?, 0, 0.9, 'Cyanocitta cristata', 'Cyanocitta cristata', ?, 'birdcam', ?, 8)
+    """, (f'{detection_date} 08:00:00', frigate_event, detection_date))
+    conn.commit()
+
+
+def visible_events(reader):
+    events = set()
+    for schema in retention.detection_sources(reader, '2000-01-01', '2099-12-31'):
+        events.update(row[0] for row in reader.execute(f"SELECT frigate_event FROM {schema}.detections"))
+    return events
+
+
+def test_reads_during_archive_see_every_detection(conn, tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    expected = set()
+    for year in (2020, 2021):
+        for day in range(1, 4):
+            add_detection(conn, f'{year}-{day}', f'{year}-01-0{day}')
+            expected.add(f'{year}-{day}')
+
+    # read from another connection between batches, once the rows of the earlier batches are gone from main
+    reader = db.connect(conn.execute("PRAGMA database_list").fetchone()[2])
+    reads = []
+    bump = generations.bump
+
+    def bump_and_read(cursor, *dates):
+        reads.append(visible_events(reader))
+        bump(cursor, *dates)
+
+    monkeypatch.setattr(retention.generations, 'bump', bump_and_read)
+    assert retention.archive(conn, hot_days=30, batch_size=1) == 6
+
+    assert len(reads) == 6
+    assert all(seen == expected for seen in reads)
+    assert visible_events(reader) == expected
+    assert conn.execute("SELECT COUNT(*) FROM detections").fetchone()[0] == 0
+    reader.close()
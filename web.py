@@ -0,0 +1,67 @@
+import os
+
+import yaml
+from gunicorn.app.base import BaseApplication
+
+import db
+import metrics
+from migrations import migrate
+
+# The web UI entrypoint. It never imports the classification stack (tflite, cv2, numpy): the
+# model is loaded by the ingest process only, so the web process starts quickly and stays small.
+
+CONFIG_PATH = './config/config.yml'
+
+
+def load_config():
+    with open(CONFIG_PATH, 'r') as config_file:
+        return yaml.safe_load(config_file)
+
+
+class WebApplication(BaseApplication):
+    """Runs the Flask app under gunicorn with threaded workers.
+
+    The app is imported in each worker rather than in the master, so restarting a worker
+    doesn't need the master to hold a copy of it.
+    """
+
+    def __init__(self, app_config):
+        self.app_config = app_config
+        super().__init__()
+
+    def load_config(self):
+        webui_config = self.app_config['webui']
+        settings = {
+            'bind': f"{webui_config['host']}:{webui_config['port']}",
+            'workers': webui_config.get('workers', 2),
+            # every open page holds a thread for its live update stream, up to live_updates.max_streams
+            'threads': webui_config.get('threads', 8),
+            'worker_class': 'gthread',
+            'timeout': webui_config.get('timeout', 60),
+            'accesslog': '-' if webui_config.get('access_log', False) else None,
+        }
+        for key, value in settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import webui
+
+        # each worker keeps its own metrics; they are exported so any worker's /metrics shows them all
+        metrics_config = self.app_config.get('metrics', {})
+        metrics.start_exporter(f'web-{os.getpid()}', metrics_config.get('export_interval', 15),
+                               metrics_config.get('path', metrics.METRICS_DIR),
+                               labels={'process': 'web', 'worker': os.getpid()})
+        return webui.init_app(self.app_config)
+
+
+def main():
+    config = load_config()
+    conn = db.connect()
+    migrate(conn)
+    conn.close()
+    print("Starting web UI", flush=True)
+    WebApplication(config).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,25 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, abort, send_from_directory
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, send_file, abort, send_from_directory
 import sqlite3
 import base64
 from datetime import datetime, date
-import yaml
 import requests
 from io import BytesIO
 from queries import recent_detections, get_daily_summary, get_common_name, get_records_for_date_hour
 from queries import get_records_for_scientific_name_and_date, get_earliest_detection_date
+from queries import get_records_for_scientific_name_and_date_range, get_species_counts, get_daily_histogram
+from queries import get_hourly_histogram, get_first_last_seen, iter_detections, export_page_end, decode_cursor
+from export import FORMATS, stream_records
+from media_proxy import build_media_proxy
+from queries import get_common_name_stats, get_detection_changes, get_last_change_id
+from live_updates import build_change_feed, stream
+from pagecache import build_page_cache, etag
+import metrics
 
 app = Flask(__name__)
 config = None
+media_proxy = None
+change_feed = None
+page_cache = None
 DBPATH = './data/speciesid.db'
 NAMEDBPATH = './birdnames.db'
 
@@ -22,103 +32,282 @@ def format_datetime(value, format='%B %d, %Y %H:%M:%S'):
 app.jinja_env.filters['datetime'] = format_datetime
 
 
+def common_name_samples():
+    return [({'stat': key}, value) for key, value in get_common_name_stats().items()]
+
+
+def media_cache_samples():
+    if media_proxy is None:
+        return []
+    return [({'stat': key}, value) for key, value in media_proxy.cache.stats().items()]
+
+
+def live_update_samples():
+    if change_feed is None:
+        return []
+    return [({'stat': key}, value) for key, value in change_feed.stats().items()]
+
+
+def page_cache_samples():
+    if page_cache is None:
+        return []
+    return [({'stat': key}, value) for key, value in page_cache.stats().items()]
+
+
+metrics.gauge('whosatmyfeeder_common_names', "Common name cache counters", common_name_samples)
+metrics.gauge('whosatmyfeeder_media_cache', "Media proxy disk cache counters", media_cache_samples)
+metrics.gauge('whosatmyfeeder_live_updates', "Live update stream counters", live_update_samples)
+metrics.gauge('whosatmyfeeder_page_cache', "Page and query result cache counters", page_cache_samples)
+
+# pages with live updates are cached with this in place of the change id their stream resumes from
+LAST_CHANGE_ID_MARK = '__last_change_id__'
+
+
+def get_media_proxy():
+    global media_proxy
+    if media_proxy is None:
+        media_proxy = build_media_proxy(config)
+    return media_proxy
+
+
+def get_change_feed():
+    global change_feed
+    if change_feed is None:
+        change_feed = build_change_feed(config.get('live_updates'), config['webui'].get('threads', 8))
+    return change_feed
+
+
+def get_page_cache():
+    global page_cache
+    if page_cache is None:
+        page_cache = build_page_cache(config.get('webui'))
+    return page_cache
+
+
+def cached_response(key, get_version, render, mimetype='text/html', live=False):
+    """Serves what render(last_change_id) returns, from the page cache while get_version(cache) is unchanged.
+
+    Browsers get an ETag and a 304 when their copy is current. Pages with live updates are
+    cached with a mark in place of the change id and get the current one filled in, so a cached
+    page's stream neither misses changes nor replays a long backlog.
+    """
+    cache = get_page_cache()
+    if cache is None:
+        return Response(render(get_last_change_id() if live else None), mimetype=mimetype)
+
+    # read before the page data, so a change that lands in between is replayed rather than missed
+    version = get_version(cache)
+    last_change_id = cache.last_change_id() if live else None
+    tag = etag(key, (version, last_change_id))
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        body = cache.get(key, version)
+        if body is None:
+            body = render(LAST_CHANGE_ID_MARK if live else None)
+            body = body.encode() if isinstance(body, str) else body
+            cache.put(key, version, body)
+        if live:
+            body = body.replace(LAST_CHANGE_ID_MARK.encode(), str(last_change_id).encode())
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(tag)
+    # browsers may keep the page, but must check it is still current before using it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @app.route('/')
 def index():
     today = datetime.now()
     date_str = today.strftime('%Y-%m-%d')
-    earliest_date = get_earliest_detection_date()
-    recent_records = recent_detections(5)
-    daily_summary = get_daily_summary(today)
-    return render_template('index.html', recent_detections=recent_records, daily_summary=daily_summary,
-                           current_hour=today.hour, date=date_str, earliest_date=earliest_date)
+
+    def render(last_change_id):
+        return render_template('index.html', recent_detections=recent_detections(5),
+                               daily_summary=get_daily_summary(today), current_hour=today.hour, date=date_str,
+                               earliest_date=get_earliest_detection_date(), last_change_id=last_change_id)
+
+    # the recent detections may be from any day, so any change at all invalidates the page
+    return cached_response(('index', date_str, today.hour),
+                           lambda cache: (cache.last_change_id(), cache.generation(date_str), cache.earliest_date()),
+                           render, live=True)
 
 
 @app.route('/frigate/<frigate_event>/thumbnail.jpg')
 def frigate_thumbnail(frigate_event):
-    frigate_url = config['frigate']['frigate_url']
-    try:
-        response = requests.get(f'{frigate_url}/api/events/{frigate_event}/thumbnail.jpg', stream=True)
-
-        if response.status_code == 200:
-            return send_file(response.raw, mimetype=response.headers['Content-Type'])
-        else:
-            # Return the single transparent pixel image from the local file if the actual image is not found
-            return send_from_directory('static/images', '1x1.png', mimetype='image/png')
-    except Exception as e:
-        print(f"Error fetching image from frigate: {e}", flush=True)
-        abort(500)
+    return get_media_proxy().image(frigate_event, 'thumbnail')
 
 
 @app.route('/frigate/<frigate_event>/snapshot.jpg')
 def frigate_snapshot(frigate_event):
-    frigate_url = config['frigate']['frigate_url']
-    try:
-        # Fetch the image from frigate
-        print("Getting snapshot from Frigate", flush=True)
-        response = requests.get(f'{frigate_url}/api/events/{frigate_event}/snapshot.jpg', stream=True)
-
-        if response.status_code == 200:
-            # Serve the image to the client using Flask's send_file()
-            return send_file(response.raw, mimetype=response.headers['Content-Type'])
-        else:
-            # Return the single transparent pixel image from the local file if the actual image is not found
-            return send_from_directory('static/images', '1x1.png', mimetype='image/png')
-    except Exception as e:
-        # If there's any issue fetching the image, return a 500 error
-        print(f"Error fetching image from frigate: {e}", flush=True)
-        abort(500)
+    return get_media_proxy().image(frigate_event, 'snapshot')
 
 
 @app.route('/frigate/<frigate_event>/clip.mp4')
 def frigate_clip(frigate_event):
-    frigate_url = config['frigate']['frigate_url']
-    try:
-        # Fetch the clip from frigate
-        print("Getting snapshot from Frigate", flush=True)
-        response = requests.get(f'{frigate_url}/api/events/{frigate_event}/clip.mp4', stream=True)
+    return get_media_proxy().clip(frigate_event)
 
-        if response.status_code == 200:
-            # Serve the image to the client using Flask's send_file()
-            return send_file(response.raw, mimetype=response.headers['Content-Type'])
-        else:
-            # Return the single transparent pixel image from the local file if the actual image is not found
-            return send_from_directory('static/images', '1x1.png', mimetype='image/png')
-    except Exception as e:
-        # If there's any issue fetching the image, return a 500 error
-        print(f"Error fetching clip from frigate: {e}", flush=True)
-        abort(500)
+
+@app.route('/metrics')
+def show_metrics():
+    metrics_config = config.get('metrics', {})
+    return Response(metrics.render(metrics_config.get('path', metrics.METRICS_DIR)),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/detections/by_hour/<date>/<int:hour>')
 def show_detections_by_hour(date, hour):
-    records = get_records_for_date_hour(date, hour)
-    return render_template('detections_by_hour.html', date=date, hour=hour, records=records)
+    def render(_):
+        return render_template('detections_by_hour.html', date=date, hour=hour,
+                               records=get_records_for_date_hour(date, hour))
+
+    return cached_response(('by_hour', date, hour), lambda cache: cache.generation(date), render)
 
 
 @app.route('/detections/by_scientific_name/<scientific_name>/<date>', defaults={'end_date': None})
 @app.route('/detections/by_scientific_name/<scientific_name>/<date>/<end_date>')
 def show_detections_by_scientific_name(scientific_name, date, end_date):
-    if end_date is None:
-        records = get_records_for_scientific_name_and_date(scientific_name, date)
+    def render(_):
+        if end_date is None:
+            records = get_records_for_scientific_name_and_date(scientific_name, date)
+        else:
+            records = get_records_for_scientific_name_and_date_range(scientific_name, date, end_date)
         return render_template('detections_by_scientific_name.html', scientific_name=scientific_name, date=date,
                                end_date=end_date, common_name=get_common_name(scientific_name), records=records)
 
+    return cached_response(('by_scientific_name', scientific_name, date, end_date),
+                           lambda cache: cache.generation(date, end_date), render)
+
 
 @app.route('/daily_summary/<date>')
 def show_daily_summary(date):
     date_datetime = datetime.strptime(date, "%Y-%m-%d")
-    daily_summary = get_daily_summary(date_datetime)
     today = datetime.now().strftime('%Y-%m-%d')
-    earliest_date = get_earliest_detection_date()
-    return render_template('daily_summary.html', daily_summary=daily_summary, date=date, today=today,
-                           earliest_date=earliest_date)
 
+    def render(last_change_id):
+        return render_template('daily_summary.html', daily_summary=get_daily_summary(date_datetime), date=date,
+                               today=today, earliest_date=get_earliest_detection_date(),
+                               last_change_id=last_change_id)
 
-def load_config():
-    global config
-    file_path = './config/config.yml'
-    with open(file_path, 'r') as config_file:
-        config = yaml.safe_load(config_file)
+    return cached_response(('daily_summary', date, today),
+                           lambda cache: (cache.generation(date), cache.earliest_date()), render, live=True)
+
+
+@app.route('/events/stream')
+def event_stream():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    since = int(since) if since and since.isdigit() else None
+    live_config = config.get('live_updates', {})
+    feed = get_change_feed()
+    subscription = feed.subscribe()
+    if subscription is None:
+        # every stream slot of this worker is taken; the page falls back to polling
+        return Response("Too many live update streams\n", status=503, mimetype='text/plain',
+                        headers={'Retry-After': '60'})
+    response = Response(stream(feed, subscription, since, keepalive=live_config.get('keepalive', 15)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # also when the client goes away before the stream is first read
+    response.call_on_close(lambda: feed.unsubscribe(subscription))
+    return response
+
+
+@app.route('/api/detections/changes')
+def detection_changes():
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    changes = get_detection_changes(since, limit)
+    return jsonify({'last_id': changes[-1]['id'] if changes else since, 'changes': changes})
+
+
+def date_range_args():
+    """Reads the start and end query parameters, defaulting to everything up to today."""
+    start = request.args.get('start') or get_earliest_detection_date() or datetime.now().strftime('%Y-%m-%d')
+    end = request.args.get('end') or datetime.now().strftime('%Y-%m-%d')
+    try:
+        datetime.strptime(start, '%Y-%m-%d')
+        datetime.strptime(end, '%Y-%m-%d')
+    except ValueError:
+        abort(400, "start and end must be dates in YYYY-MM-DD format")
+    return start, end
+
+
+@app.route('/api/species')
+def species_counts():
+    start, end = date_range_args()
+    return cached_response(('api_species', start, end), lambda cache: cache.generation(start, end),
+                           lambda _: jsonify({'start': start, 'end': end,
+                                              'species': get_species_counts(start, end)}).get_data(),
+                           mimetype='application/json')
+
+
+@app.route('/api/species/<scientific_name>')
+def species_details(scientific_name):
+    start, end = date_range_args()
+
+    def render(_):
+        first_seen, last_seen = get_first_last_seen(scientific_name)
+        return jsonify({
+            'scientific_name': scientific_name,
+            'common_name': get_common_name(scientific_name),
+            'first_seen': first_seen,
+            'last_seen': last_seen,
+            'start': start,
+            'end': end,
+            'daily': get_daily_histogram(start, end, scientific_name),
+            'hourly': get_hourly_histogram(start, end, scientific_name),
+        }).get_data()
+
+    # first and last seen cover every day, not just the range
+    return cached_response(('api_species_details', scientific_name, start, end),
+                           lambda cache: cache.generation('0000-00-00', '9999-12-31'), render,
+                           mimetype='application/json')
 
 
-load_config()
+@app.route('/api/histogram/<interval>')
+def histogram(interval):
+    start, end = date_range_args()
+    species = request.args.get('species')
+    if interval == 'daily':
+        query = get_daily_histogram
+    elif interval == 'hourly':
+        query = get_hourly_histogram
+    else:
+        abort(404)
+    return cached_response(('api_histogram', interval, start, end, species),
+                           lambda cache: cache.generation(start, end),
+                           lambda _: jsonify({'start': start, 'end': end, 'species': species,
+                                              'counts': query(start, end, species)}).get_data(),
+                           mimetype='application/json')
+
+
+@app.route('/api/export')
+def export_detections():
+    start, end = date_range_args()
+    export_format = request.args.get('format', 'csv')
+    if export_format not in FORMATS:
+        abort(400, f"format must be one of {', '.join(FORMATS)}")
+    species = request.args.get('species')
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', type=int)
+
+    headers = {'Content-Disposition': f'attachment; filename=detections-{start}-{end}.{export_format}'}
+    try:
+        if cursor is not None:
+            decode_cursor(cursor)
+        if limit is not None:
+            # a page of a larger export; the client continues from X-Next-Cursor until it's absent
+            limit = max(1, limit)
+            next_cursor = export_page_end(start, end, species, cursor, limit)
+            if next_cursor is not None:
+                headers['X-Next-Cursor'] = next_cursor
+        records = iter_detections(start, end, species, cursor, limit)
+    except ValueError as e:
+        abort(400, str(e))
+    return Response(stream_records(records, export_format), mimetype=FORMATS[export_format], headers=headers)
+
+
+def init_app(app_config):
+    """Gives the app its configuration. Nothing is read at import time, so importing this module is cheap."""
+    global config
+    config = app_config
+    return app